@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Planning time of allocate.plan for random portfolios over many asset
+# classes and providers, with offline exchange rates. "exact" counts
+# plans proven optimal: none at the default size, where the search runs
+# out of nodes and returns the best plan found; 10 asset classes at 3
+# providers are small enough to prove.
+#
+#    python benchmarks/allocate.py [aclasses] [providers]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from autopie import currency
+from autopie import allocate
+from autopie.core import Provider, Product, Price, RealPortfolio
+
+ACLASSES = 30
+PROVIDERS = 10
+RUNS = 20
+
+class Bench(Provider):
+    def __init__(self, name, products, cash):
+        super().__init__(name)
+        self._products = products
+        self._cash = cash
+        self._assets = []
+
+    def init(self, **data):
+        pass
+
+    def clean(self):
+        pass
+
+    @property
+    def buyable(self):
+        return self._products
+
+    @property
+    def cash(self):
+        return self._cash
+
+def setup(aclasses, providers, rng):
+    providers = [
+        Bench(f"p{i}", [
+            Product(
+                f"p{i}-{ac}", ac,
+                Price(Decimal(rng.randint(100, 50000)) / 100, rng.choice(("usd", "eur"))),
+                f"p{i}",
+                {
+                    "quantity_places": rng.choice((0, 0, 2, 8)),
+                    "spread": Decimal(rng.randint(1, 50)) / 10000,
+                    "fee": Decimal(rng.randint(0, 40)) / 10000,
+                    "ordermin": Decimal(rng.choice((0, 1))),
+                },
+            )
+            for ac in rng.sample(aclasses, len(aclasses) // 3)
+        ], Price(rng.randint(100, 20000), "usd") if rng.random() < 0.5 else None)
+        for i in range(providers)
+    ]
+    portfolio = RealPortfolio(
+            values={ac: Decimal(rng.randint(0, 500000)) / 100 for ac in aclasses},
+            currency="czk",
+        )
+    return portfolio, providers
+
+def main():
+    n_aclasses = int(sys.argv[1]) if len(sys.argv) > 1 else ACLASSES
+    n_providers = int(sys.argv[2]) if len(sys.argv) > 2 else PROVIDERS
+
+    cache = os.path.join(tempfile.mkdtemp(), "rates.json")
+    with open(cache, "w") as fp:
+        json.dump({"eur": {"timestamp": time.time(), "rates": {"eur": 1, "usd": 1.08, "czk": 25.2}}}, fp)
+    currency.init(cache_file=cache, offline=True, pivot="eur")
+
+    rng = random.Random(1)
+    aclasses = [f"ac{i}" for i in range(n_aclasses)]
+    times = []
+    exact = 0
+    leftover = Decimal(0)
+    for _ in range(RUNS):
+        portfolio, providers = setup(aclasses, providers=n_providers, rng=rng)
+        start = time.perf_counter()
+        orders, ok = allocate.plan(portfolio, providers)
+        times.append(time.perf_counter() - start)
+        exact += ok
+        leftover += (portfolio.total - sum(o.cost for o in orders)) / portfolio.total
+    times.sort()
+    print(f"{n_aclasses} asset classes, {n_providers} providers, {RUNS} runs")
+    print(f"median {times[len(times)//2]*1000:.1f} ms, max {times[-1]*1000:.1f} ms")
+    print(f"exact {exact}/{RUNS}, mean leftover {leftover/RUNS:.2%}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Memory and construction throughput of Price/Product/Asset compared with
+# the former dict-backed classes.
+#
+#    python benchmarks/core_types.py [count]
+
+import os
+import string
+import sys
+import timeit
+import tracemalloc
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from autopie.core import Price, Product, Asset
+
+COUNT = 100_000
+
+class OldPrice:
+    def __init__(self, *args, num=None, unit=None):
+        if len(args) == 2:
+            self.num = args[0]
+            self.unit = args[1]
+        elif len(args) == 1:
+            s = args[0].strip()
+            self.num = s.rstrip(string.ascii_letters+string.whitespace)
+            self.unit = s.lstrip("."+string.digits+string.whitespace)
+        else:
+            self.num = num
+            self.unit = unit
+        self.num = Decimal(self.num)
+        self.unit = self.unit.lower()
+
+class OldProduct:
+    def __init__(self, name, aclass, price, provider, other=None):
+        self.name = name
+        self.aclass = aclass
+        self.price = price
+        self.provider = provider
+        self.other = {} if other is None else other
+
+class OldAsset:
+    def __init__(self, product, amount):
+        self.product = product
+        self.amount = Decimal(amount)
+        assert self.amount >= 0
+
+def build(P, Pr, A, count):
+    num = Decimal("56500.25")
+    amount = Decimal("1.5")
+    return [
+        A(Pr("Gold", "gold", P(num, "CZK"), "offline"), amount)
+        for _ in range(count)
+    ]
+
+def memory(P, Pr, A, count):
+    tracemalloc.start()
+    objs = build(P, Pr, A, count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    for label, classes in (("dict", (OldPrice, OldProduct, OldAsset)), ("slots", (Price, Product, Asset))):
+        seconds = min(timeit.repeat(lambda: build(*classes, count), number=1, repeat=5))
+        size = memory(*classes, count)
+        print(f"{label:6} {count/seconds/1000:8.0f} k assets/s {size/count:6.0f} B/asset")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
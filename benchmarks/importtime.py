@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Cold start regression check: import of the CLI must stay within budget
+# and must not pull in heavy libraries.
+#
+#    python benchmarks/importtime.py [budget_ms]
+
+import os
+import subprocess
+import sys
+
+MODULE = "autopie.main"
+BUDGET_MS = 150
+RUNS = 5
+HEAVY = ("pandas", "numpy", "yfinance", "requests", "krakenex", "websocket")
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+def importtime():
+    """Return ({module: cumulative us}) of one cold import of MODULE"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC, env.get("PYTHONPATH")]))
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        capture_output=True, text=True, check=True, env=env,
+    ).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    runs = [importtime() for _ in range(RUNS)]
+    best = min(run[MODULE.split(".")[0]] for run in runs) / 1000
+    heavy = sorted({m for run in runs for m in run if m.split(".")[0] in HEAVY})
+
+    print(f"import {MODULE}: {best:.1f} ms (budget {budget:.0f} ms)")
+    ok = True
+    if heavy:
+        print(f"FAIL: heavy modules imported at start: {heavy}")
+        ok = False
+    if best > budget:
+        print(f"FAIL: over budget")
+        ok = False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
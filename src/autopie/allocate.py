@@ -0,0 +1,350 @@
+from decimal import Decimal, ROUND_CEILING
+
+from .util import *
+from .core import Catalog, RealPortfolio
+from .currency import get_rate
+from . import money
+
+# Plans purchases of a portfolio across all providers at once, in integer
+# lots, respecting order minimums, per-provider cash and fees.
+#
+# Branch and bound over the number of lots of each product maximizes the
+# value bought (at mid prices, so leftover, spread and fees count
+# against it), then minimizes the number of orders. Every lot count is
+# considered, only ones the bounds prove cannot do better are pruned, so
+# a search finishing within NODE_BUDGET is optimal and reported exact.
+#
+# Proving takes few nodes only for small inputs: a handful of asset
+# classes sharing limited cash (benchmarks/allocate.py 10 3 is exact in
+# every run). With dozens sharing it (30 asset classes, 10 providers)
+# the bounds, which ignore lot sizes, are too loose to prove any plan and
+# the search always runs out of NODE_BUDGET. Its first leaf is the greedy
+# plan (most lots of the cheapest product first) and the rest of the
+# budget only improves on it, the result is reported as not exact.
+#
+# Asset classes not sharing a provider with limited cash are searched
+# separately, products whose smallest order does not fit are left out.
+
+NODE_BUDGET = 20000
+# values (in the smallest currency unit) closer than this are equal
+TOLERANCE = 1e-6
+
+class Order:
+    """Buy amount of product at provider for cost in portfolio currency"""
+    __slots__ = ("provider", "product", "amount", "cost")
+
+    def __init__(self, provider, product, amount, cost):
+        self.provider = provider
+        self.product = product
+        self.amount = amount
+        self.cost = cost
+
+    def __str__(self):
+        return f"Order({self.provider.name}: {self.product.name} x{self.amount} for {self.cost:.2f})"
+
+    def __repr__(self):
+        return str(self)
+
+class _Item:
+    """Product of a provider, prices per lot in portfolio currency"""
+    __slots__ = ("provider", "product", "aclass", "lot", "lot_cost", "lot_value", "nmin", "fee")
+
+def _items(budget, providers, rate):
+    items = []
+    for i, provider in enumerate(providers):
+        for ac in budget:
+            for product in provider.catalog.products(ac):
+                if product.price.num <= 0:
+                    continue
+                other = product.other
+                r = rate(product.price.unit)
+                item = _Item()
+                item.provider = i
+                item.product = product
+                item.aclass = ac
+                item.lot = Decimal(1).scaleb(
+                        -other.get("quantity_places", money.DEFAULT_QUANTITY_PLACES))
+                item.lot_cost = item.lot * Catalog.cost(product) * r
+                item.lot_value = item.lot * product.price.num * r
+                item.nmin = max(1, int(
+                        (Decimal(other.get("ordermin", 0)) / item.lot)
+                            .to_integral_value(rounding=ROUND_CEILING)))
+                item.fee = Decimal(other.get("order_fee", 0)) * r
+                items.append(item)
+    # largest budgets first, cheapest products first within an asset class
+    items.sort(key=lambda it: (-budget[it.aclass], it.aclass, it.lot_cost / it.lot_value))
+    return items
+
+def _exact(item, places):
+    """Lot cost and order fee in the smallest currency unit, as integer ratios"""
+    scale = 10**places
+    return (item.lot_cost * scale).as_integer_ratio() + (item.fee * scale).as_integer_ratio()
+
+def _spend_units(exact, k):
+    # what k lots cost in the smallest currency unit, rounded up
+    cn, cd, fn, fd = exact
+    return -(-(k * cn * fd + fn * cd) // (cd * fd))
+
+def _spend(item, k, places):
+    return money.to_decimal(_spend_units(_exact(item, places), k), places)
+
+def _rest(items, value, cost, cash):
+    """
+    Per item index i, what items i.. can still buy, for bounds: (free,
+    limited, pool, rmax) with free [(aclass, best value per cost)] of
+    asset classes a provider with unlimited cash sells, limited
+    [(aclass, ratio, providers)] of the others, pool the providers of
+    limited and rmax their best ratio
+    """
+    n = len(items)
+    rest = [None] * (n + 1)
+    rest[n] = ((), (), (), 0.0)
+    classes = {}
+    for i in range(n - 1, -1, -1):
+        item = items[i]
+        ratio, unlimited, ps = classes.get(item.aclass, (0.0, False, frozenset()))
+        ratio = max(ratio, value[i] / cost[i])
+        if cash[item.provider] is None:
+            unlimited = True
+        else:
+            ps = ps | {item.provider}
+        classes[item.aclass] = (ratio, unlimited, ps)
+        free = tuple((ac, r) for ac, (r, u, _) in classes.items() if u)
+        limited = tuple((ac, r, tuple(ps)) for ac, (r, u, ps) in classes.items() if not u)
+        pool = tuple(set().union(*(ps for _, _, ps in limited)))
+        rmax = max((r for _, r, _ in limited), default=0.0)
+        rest[i] = (free, limited, pool, rmax)
+    return rest
+
+def _search(items, budget, cash, places, node_budget):
+    """(lots per item, exact) of the best plan for items"""
+    # bounds in floats, spending in integers of the smallest currency unit
+    scale = 10**places
+    cost = [float(it.lot_cost) * scale for it in items]
+    fee = [float(it.fee) * scale for it in items]
+    value = [float(it.lot_value) * scale for it in items]
+    budget = {ac: money.to_units(v, places, rounding=money.ROUND_DOWN) for ac, v in budget.items()}
+    cash = [None if c is None else money.to_units(c, places, rounding=money.ROUND_DOWN) for c in cash]
+    exact = [_exact(it, places) for it in items]
+    def spend(i, k):
+        return _spend_units(exact[i], k)
+
+    n = len(items)
+    rest = _rest(items, value, cost, cash)
+
+    def bound(j):
+        """
+        (upper bound of the value items j.. can add, the two bounds of
+        limited, spent budget of limited, their providers' cash)
+        """
+        free, limited, pool, rmax = rest[j]
+        total = 0.0
+        for ac, r in free:
+            total += budget[ac] * r
+        if not limited:
+            return (total, 0.0, 0.0, 0, 0)
+        # each class by itself, cash counted for all classes sharing it
+        part1 = 0.0
+        budgets = 0
+        for ac, r, ps in limited:
+            b = budget[ac]
+            budgets += b
+            part1 += r * min(b, sum(cash[p] for p in ps))
+        # all together, at the best ratio
+        cashes = sum(cash[p] for p in pool)
+        part2 = rmax * min(budgets, cashes)
+        return (total + min(part1, part2), part1, part2, budgets, cashes)
+
+    # what bound(i + 1) depends on when item i spends less: the ratio of
+    # its asset class among free or limited, limited classes sharing its
+    # provider, if its provider is in the pool
+    shared = []
+    for i, item in enumerate(items):
+        free, limited, pool, rmax = rest[i + 1]
+        p = item.provider if cash[item.provider] is not None else None
+        shared.append((
+            next((r for ac, r in free if ac == item.aclass), 0.0),
+            next((r for ac, r, _ in limited if ac == item.aclass), None),
+            tuple((ac, r, ps) for ac, r, ps in limited if ac != item.aclass and p in ps),
+            p in pool,
+        ))
+
+    def growth(i, parts):
+        """
+        (alpha, extra) with bound(i + 1) growing at most alpha * d + extra
+        when item i spends d less, or None if alpha would exceed the
+        item's own value per cost
+        """
+        r_free, r_limited, others, in_pool = shared[i]
+        _, part1, part2, budgets, cashes = parts
+        least = min(part1, part2)
+        rmax = rest[i + 1][3]
+        forms = []
+        # part1: its own class grows with d, the others sharing its
+        # provider at most by what cash lacks for their budget
+        extra = part1 - least
+        for ac, r, ps in others:
+            extra += r * max(0, budget[ac] - sum(cash[p] for p in ps))
+        forms.append((r_limited or 0.0, extra))
+        # part2: budgets and cash grow with d, as far as the other allows
+        extra = part2 - least
+        if r_limited is not None and in_pool:
+            forms.append((rmax, extra))
+        elif r_limited is not None:
+            forms.append((0.0, extra + rmax * max(0, cashes - budgets)))
+        elif in_pool:
+            forms.append((0.0, extra + rmax * max(0, budgets - cashes)))
+        else:
+            forms.append((0.0, extra))
+        ratio = value[i] / cost[i]
+        fits = [(r_free + a, e) for a, e in forms if r_free + a <= ratio]
+        return min(fits, key=lambda f: f[1]) if fits else None
+
+    # items no later item competes with for budget or limited cash: the
+    # most lots that fit beat any fewer, the money left is of no use
+    last = [True] * n
+    later = set()
+    for i in range(n - 1, -1, -1):
+        item = items[i]
+        keys = {("aclass", item.aclass)}
+        if cash[item.provider] is not None:
+            keys.add(("provider", item.provider))
+        last[i] = not (keys & later)
+        later |= keys
+
+    counts = [0] * n
+    best = [-1.0, 0, counts[:]] # value, orders, counts
+    nodes = 0
+
+    def beaten(ub, orders):
+        # no plan worth up to ub with at least orders orders is better
+        return ub < best[0] - TOLERANCE or (ub <= best[0] + TOLERANCE and orders >= best[1])
+
+    def search(i, v, orders, ub):
+        nonlocal nodes
+        if v > best[0] + TOLERANCE or (v >= best[0] - TOLERANCE and orders < best[1]):
+            best[:] = [v, orders, counts[:]]
+        if i == n or beaten(ub, orders):
+            return
+
+        item = items[i]
+        ac = item.aclass
+        p = item.provider
+        c = cash[p]
+        avail = budget[ac] if c is None else min(budget[ac], c)
+        # one more in case of float error, spend decides
+        kmax = int((avail - fee[i]) / cost[i]) + 1 if avail > fee[i] else 0
+        # every lot count, most first, so the first leaf is greedy
+        for k in range(kmax, item.nmin - 1, -1):
+            if nodes > node_budget:
+                return
+            s = spend(i, k)
+            if s > avail:
+                continue
+            nodes += 1
+            budget[ac] -= s
+            if c is not None:
+                cash[p] -= s
+            counts[i] = k
+            parts = bound(i + 1)
+            child = v + k * value[i] + parts[0]
+            if beaten(child, orders + 1):
+                # fewer lots can only do better by what the bound of the
+                # rest grows with the money they leave (plus a unit of
+                # rounding of spend and float error); if it does not grow
+                # faster than this item's value, none of them can
+                g = growth(i, parts)
+                stop = g is not None and beaten(child + g[0] * (avail * 1e-9 + 1) + g[1], orders + 1)
+            else:
+                stop = False
+                search(i + 1, v + k * value[i], orders + 1, child)
+            counts[i] = 0
+            budget[ac] += s
+            if c is not None:
+                cash[p] += s
+            if last[i]:
+                # skipping it leaves less value too
+                return
+            if stop:
+                break
+        if nodes > node_budget:
+            return
+        nodes += 1
+        search(i + 1, v, orders, v + bound(i + 1)[0])
+
+    search(0, 0.0, 0, bound(0)[0])
+    return (best[2], nodes <= node_budget)
+
+def _components(items, cash):
+    """Items split into groups not sharing limited cash, in item order"""
+    # asset classes bought from the same provider with limited cash
+    # compete for it, others are independent
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            x = parent[x]
+        return x
+    for item in items:
+        a = find(("aclass", item.aclass))
+        if cash[item.provider] is not None:
+            parent[a] = find(("provider", item.provider))
+    groups = {}
+    for item in items:
+        groups.setdefault(find(("aclass", item.aclass)), []).append(item)
+    return list(groups.values())
+
+def plan(portfolio, providers, node_budget=NODE_BUDGET):
+    """
+    ([Order], exact) buying portfolio (RealPortfolio) from providers,
+    exact is False if the search ran out of node_budget
+    """
+    currency = portfolio.currency
+    places = money.places(currency)
+    rates = {}
+    def rate(unit):
+        r = rates.get(unit, None)
+        if r is None:
+            r = rates[unit] = get_rate(unit, currency)
+        return r
+
+    budget = {ac: v for ac, v in portfolio.values.items() if v > 0}
+    items = _items(budget, providers, rate)
+    cash = []
+    for provider in providers:
+        c = provider.cash
+        cash.append(None if c is None else c.num * rate(c.unit))
+    # never bought, left out they neither loosen the bounds nor join
+    # asset classes into one search
+    def fits(item):
+        c = cash[item.provider]
+        avail = budget[item.aclass] if c is None else min(budget[item.aclass], c)
+        return _spend(item, item.nmin, places) <= avail
+    items = [item for item in items if fits(item)]
+    debug(f"allocate: {len(items)} products for {len(budget)} asset classes, cash {cash}")
+
+    orders = []
+    exact = True
+    for group in _components(items, cash):
+        counts, done = _search(group, budget, cash, places, node_budget)
+        if not done:
+            debug(f"allocate: node budget {node_budget} exhausted for {len(group)} products, using best plan found")
+            exact = False
+        for item, k in zip(group, counts):
+            if k:
+                orders.append(Order(providers[item.provider], item.product, k * item.lot, _spend(item, k, places)))
+    debug(f"allocate: {len(orders)} orders for {sum(o.cost for o in orders):.2f}{currency}, exact {exact}")
+    return (orders, exact)
+
+def execute(orders, providers, currency):
+    """Place orders, [(provider, RealPortfolio bought)] for every provider"""
+    bought = {id(p): RealPortfolio(currency=currency) for p in providers}
+    for order in orders:
+        provider = order.provider
+        debug(f"allocate: placing {order}")
+        amount = Decimal(provider.buy(order.product, order.amount) or 0)
+        if amount:
+            bought[id(provider)] += RealPortfolio(
+                    values={order.product.aclass: provider.spent(order.product, amount, currency)},
+                    currency=currency,
+                )
+    return [(p, bought[id(p)]) for p in providers]
@@ -0,0 +1,147 @@
+import numpy as np
+
+from .util import *
+from .core import AbstractPortfolio, action_batch
+from .vector import AClassIndex
+
+# Replays strategies over the monthly history: every month `contribution`
+# is split among asset classes like invest does and bought at that
+# month's average price through a fill model. Strategies see history as
+# of that month (history.as_of). Returns, drawdown and tracking error are
+# computed over the whole time axis at once.
+#
+# Asset classes of ideal without history are left out, except cash,
+# which keeps a constant price of 1. Prices are in their own currencies.
+
+class Fill:
+    """Fill at the price, units bought for money amounts"""
+
+    def __call__(self, prices, amounts):
+        return amounts / prices
+
+    def __str__(self):
+        return self.__class__.__name__
+
+class SpreadFill(Fill):
+    """Fill paying half the (relative) spread and a fee on every purchase"""
+
+    def __init__(self, spread=0.0, fee=0.0):
+        self.spread = float(spread)
+        self.fee = float(fee)
+
+    def __call__(self, prices, amounts):
+        return amounts / (prices * (1 + self.spread / 2) * (1 + self.fee))
+
+    def __str__(self):
+        return f"SpreadFill(spread {self.spread}, fee {self.fee})"
+
+FILLS = {
+    "price": Fill,
+    "spread": SpreadFill,
+}
+
+class Result:
+    """
+    Monthly state of a backtest: months, prices and units held (months x
+    asset classes) and money invested, with metrics derived from them
+    """
+
+    def __init__(self, index, months, prices, units, invested, ideal):
+        self.index = index
+        self.months = months
+        self.prices = prices
+        self.units = units
+        self.invested = invested
+        self.ideal = ideal # ratio vector
+
+    @property
+    def values(self):
+        """Portfolio value after each month's purchase"""
+        return (self.units * self.prices).sum(axis=1)
+
+    @property
+    def weights(self):
+        values = self.units * self.prices
+        total = values.sum(axis=1, keepdims=True)
+        return np.divide(values, total, out=np.zeros_like(values), where=total > 0)
+
+    @property
+    def returns(self):
+        """Time-weighted monthly returns, contributions left out"""
+        held = (self.units[:-1] * self.prices[1:]).sum(axis=1)
+        before = self.values[:-1]
+        return np.divide(held, before, out=np.ones_like(held), where=before > 0) - 1
+
+    @property
+    def benchmark_returns(self):
+        """Monthly returns of ideal, rebalanced every month"""
+        return (self.prices[1:] / self.prices[:-1] - 1) @ self.ideal
+
+    @property
+    def drawdowns(self):
+        growth = np.cumprod(1 + self.returns)
+        return growth / np.maximum.accumulate(growth) - 1
+
+    def summary(self):
+        returns = self.returns
+        years = len(returns) / 12
+        growth = float(np.prod(1 + returns))
+        active = returns - self.benchmark_returns
+        return {
+            "months": len(self.months),
+            "invested": float(self.invested[-1]),
+            "value": float(self.values[-1]),
+            "return": growth - 1,
+            "annual_return": growth ** (1 / years) - 1 if years else 0.0,
+            "max_drawdown": float(self.drawdowns.min()) if len(returns) else 0.0,
+            "tracking_error": float(active.std(ddof=1) * np.sqrt(12)) if len(active) > 1 else 0.0,
+            # half the L1 distance of weights from ideal, averaged over time
+            "ideal_distance": float(np.abs(self.weights - self.ideal).sum(axis=1).mean() / 2),
+        }
+
+def run(strategies, ideal, *, months=240, until="last", contribution=1.0, fill=None):
+    """
+    Replay `strategies` (weighted like in invest) toward `ideal`
+    (AbstractPortfolio) over `months` months until `until`, Result
+    """
+    # here only, fill models are used without history (see simulate)
+    from . import history
+    if fill is None:
+        fill = Fill()
+    acs = [ac for ac in ideal.ratios if ac in history.COLUMNS]
+    skipped = [ac for ac in ideal.ratios if ac not in history.COLUMNS and ac != "cash"]
+    if skipped:
+        warn(f"backtest: no history for {skipped}, leaving them out")
+    if not acs:
+        error(f"backtest: no history for any of {list(ideal.ratios)}")
+    month_list, prices = history.prices(acs, num=months, until=until)
+    if "cash" in ideal.ratios:
+        acs.append("cash")
+        prices = np.column_stack((prices, np.ones(len(prices))))
+    index = AClassIndex(acs)
+    ideal = AbstractPortfolio(values={ac: ideal.ratios[ac] for ac in acs})
+    ideal_vector = index.vector(ideal.ratios)
+    debug(f"backtest: {index}, {month_list[0]}..{month_list[-1]}, fill {fill}")
+
+    total_weight = sum(s.weight for s in strategies)
+    weights = [float(s.weight / total_weight) for s in strategies]
+
+    # path dependent, strategies see what was bought so far
+    units = np.zeros_like(prices)
+    spent = np.zeros(len(month_list))
+    held = np.zeros(len(index))
+    ideal_row = ideal_vector[np.newaxis]
+    for t, month in enumerate(month_list):
+        value = held * prices[t]
+        total = value.sum()
+        current = (value / total if total else value)[np.newaxis]
+        allocation = np.zeros(len(index))
+        with history.as_of(month):
+            for strategy, weight in zip(strategies, weights):
+                allocation += weight * action_batch(strategy, ideal_row, current, index)[0]
+        held = held + fill(prices[t], allocation * contribution)
+        units[t] = held
+        spent[t] = allocation.sum() * contribution
+    debug2(f"backtest: units {units[-1]}")
+
+    return Result(index, month_list, prices, units, np.cumsum(spent), ideal_vector)
@@ -0,0 +1,118 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from .util import *
+
+# Binary columnar store for numeric data frames.
+#
+# Layout of the store directory:
+#   meta.json      {"version": 1, "columns": [...], "rows": N, "generation": G}
+#   <i>.f64        column i, N little-endian float64 values (generation 0)
+#   <i>.<G>.f64    the same, generation G
+#
+# Appended rows are written after the valid ones, updated rows (or new
+# columns) rewrite all columns as a new generation. meta.json is replaced
+# last, committing the number of rows and the generation, so an
+# interrupted write leaves the previous contents readable.
+
+VERSION = 1
+DTYPE = np.dtype("<f8")
+
+class ColumnStore:
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.rows = 0
+        self.generation = 0
+
+    def _meta_file(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _column_file(self, i, generation=None):
+        if generation is None:
+            generation = self.generation
+        if generation == 0:
+            return os.path.join(self.path, f"{i}.f64")
+        return os.path.join(self.path, f"{i}.{generation}.f64")
+
+    def exists(self):
+        return os.path.exists(self._meta_file())
+
+    def read(self, ints=()):
+        """Return the stored data frame, columns in `ints` cast to int"""
+        with open(self._meta_file(), mode="r", encoding="utf-8") as f:
+            meta = json.load(f)
+        assert meta["version"] == VERSION
+        self.columns = meta["columns"]
+        self.rows = meta["rows"]
+        self.generation = meta.get("generation", 0)
+        debug2(f"colstore: reading {self.rows} rows of {self.columns} from {self.path}")
+        data = {}
+        for i, column in enumerate(self.columns):
+            values = np.fromfile(self._column_file(i), dtype=DTYPE, count=self.rows)
+            if column in ints:
+                values = values.astype(np.int64)
+            data[column] = values
+        return pd.DataFrame(data, columns=self.columns)
+
+    def write(self, df, rows):
+        """Store df, of which only rows (positional indices) changed"""
+        columns = list(df.columns)
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        values = df.to_numpy(dtype=DTYPE)
+        if self.columns != columns:
+            debug(f"colstore: columns changed {self.columns} -> {columns}, rewriting {self.path}")
+            os.makedirs(self.path, exist_ok=True)
+            self._rewrite(columns, values)
+            return
+        if len(rows) == 0:
+            debug2(f"colstore: nothing to write to {self.path}")
+            return
+        updated = rows[rows < self.rows]
+        appended = rows[rows >= self.rows]
+        # rows are appended contiguously
+        assert len(appended) == 0 or appended[0] == self.rows
+        assert len(appended) == 0 or appended[-1] == len(df) - 1
+        debug(f"colstore: {self.path}: updating {len(updated)} rows, appending {len(appended)} rows")
+        if len(updated) > 0:
+            self._rewrite(columns, values)
+            return
+
+        # past the valid rows, not read before meta.json says so
+        for i in range(len(columns)):
+            with open(self._column_file(i), mode="r+b") as f:
+                f.seek(self.rows * DTYPE.itemsize)
+                f.write(values[appended[0]:, i].tobytes())
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+        self._commit(columns, len(df), self.generation)
+
+    def _rewrite(self, columns, values):
+        """Write all columns as a new generation"""
+        old = (len(self.columns or ()), self.generation)
+        generation = self.generation + 1
+        for i in range(len(columns)):
+            with open(self._column_file(i, generation), mode="wb") as f:
+                f.write(np.ascontiguousarray(values[:, i]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self._commit(columns, len(values), generation)
+        for i in range(old[0]):
+            try:
+                os.remove(self._column_file(i, old[1]))
+            except FileNotFoundError:
+                pass
+
+    def _commit(self, columns, rows, generation):
+        tmp = f"{self._meta_file()}.tmp"
+        with open(tmp, mode="w", encoding="utf-8") as f:
+            json.dump({"version": VERSION, "columns": columns, "rows": rows, "generation": generation}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._meta_file())
+        self.columns = columns
+        self.rows = rows
+        self.generation = generation
@@ -4,43 +4,53 @@ from decimal import Decimal
 from math import floor
 from abc import ABC, abstractmethod
 import numbers
+import sys
 import string
 from copy import deepcopy
 
 from .util import *
-from .currency import get_rate
+from .currency import get_rate, convert
+from . import money
 
-from . import history
+# interned lower-case units: raw string -> interned
+_names = {}
 
-PRECISION = Decimal(0.00000001)
-
-# class Price: ? # number, currency
-# class Product: ? # or just dict # should include price, class
-# class Asset: ? # product, num
+def _intern(name):
+    interned = _names.get(name, None)
+    if interned is None:
+        interned = sys.intern(name.lower())
+        _names[name] = interned
+    return interned
 
 class Price:
+    __slots__ = ("num", "unit")
+
     def __init__(self, *args, num=None, unit=None):
+        # fast path for already typed values, e.g. Price(Decimal("20.5"), "usd")
+        if len(args) == 2 and type(args[0]) is Decimal and num is None and unit is None:
+            self.num = args[0]
+            self.unit = _intern(args[1])
+            return
+
         if len(args) >= 1 and len(args) <= 2:
             debug2(f"Price args: {args}")
             if num is not None or unit is not None:
                 error(f"Price: extra num ({num}) and or unit ({unit})")
             if len(args) == 2:
-                self.num = args[0]
-                self.unit = args[1]
+                num = args[0]
+                unit = args[1]
             else: # len(args) == 1
                 s = args[0].strip()
-                self.num = s.rstrip(string.ascii_letters+string.whitespace)
-                self.unit = s.lstrip("."+string.digits+string.whitespace)
+                num = s.rstrip(string.ascii_letters+string.whitespace)
+                unit = s.lstrip("."+string.digits+string.whitespace)
         elif len(args) == 0:
             if num is None or unit is None:
                 error(f"Price: missing num ({num}) or unit ({unit})")
-            self.num = num
-            self.unit = unit
         else: # len(args) >= 3
             error(f"Price: too many args ({args})")
 
-        self.num = Decimal(self.num) # e.g., 20.5
-        self.unit = self.unit.lower() # e.g., "usd"
+        self.num = num if type(num) is Decimal else Decimal(num) # e.g., 20.5
+        self.unit = _intern(unit) # e.g., "usd"
 
     def __str__(self):
         return f"{self.num:.2f}{self.unit}"
@@ -49,9 +59,12 @@ class Price:
         return str(self)
 
 class Product:
+    __slots__ = ("name", "aclass", "price", "provider", "other")
+
     def __init__(self, name, aclass, price, provider, other=None):
         self.name = name
-        self.aclass = aclass
+        # case kept, ideal portfolios name asset classes as configured
+        self.aclass = sys.intern(aclass)
         self.price = price
         self.provider = provider
         if other is None:
@@ -65,15 +78,78 @@ class Product:
         return str(self)
 
 class Asset:
+    __slots__ = ("product", "amount")
+
     def __init__(self, product, amount):
         self.product = product
-        self.amount = Decimal(amount)
+        self.amount = amount if type(amount) is Decimal else Decimal(amount)
         assert self.amount >= 0
     def __str__(self):
         return f"{str(self.product)} x{self.amount:.2f}"
     def __repr__(self):
         return str(self)
 
+class Catalog:
+    """
+    Products indexed by asset class, several per class possible.
+    Products may set in `other`: spread ((ask - bid) / mid, price is the
+    mid), fee (fraction of the order), order_fee (fixed per order, in the
+    product's currency), ordermin and quantity_places.
+    """
+    def __init__(self, products):
+        self.source = products
+        self._index = {}
+        for p in products:
+            self._index.setdefault(p.aclass, []).append(p)
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        return iter(self.source)
+
+    def __contains__(self, aclass):
+        return aclass in self._index
+
+    def products(self, aclass):
+        return self._index.get(aclass, ())
+
+    @staticmethod
+    def cost(product):
+        """Effective price of one unit of product, after spread and fee"""
+        other = product.other
+        return (product.price.num
+                * (1 + Decimal(other.get("spread", 0)) / 2)
+                * (1 + Decimal(other.get("fee", 0))))
+
+    def best(self, aclass, price):
+        """
+        (product, amount) of aclass which buys the most for `price`,
+        amount rounded down to the lot, (None, None) if there is none
+        """
+        best = (None, None)
+        best_value = None
+        rates = {}
+        for p in self._index.get(aclass, ()):
+            unit = p.price.unit
+            rate = rates.get(unit, None)
+            if rate is None:
+                rate = rates[unit] = get_rate(unit, price.unit)
+            other = p.other
+            amount = money.quantize(
+                    (price.num / rate - Decimal(other.get("order_fee", 0))) / self.cost(p),
+                    other.get("quantity_places", money.DEFAULT_QUANTITY_PLACES),
+                    rounding=money.ROUND_DOWN,
+                )
+            if amount < 0 or amount < other.get("ordermin", 0):
+                amount = Decimal(0)
+            value = amount * p.price.num * rate
+            debug2(f"Catalog: {p} x{amount} worth {value:.2f}{price.unit}")
+            if best_value is None or value > best_value:
+                best = (p, amount)
+                best_value = value
+        return best
+
 # TODO think more about which methods to make abstact
 # maybe add some helper subclasses like "SimpleProvider" (containing what is here) and use Provider really as interface
 # maybe specific class for storage-only providers (physical)
@@ -109,26 +185,49 @@ class Provider(ABC):
     @property
     def buyable(self): # -> [ product ]
         return []
+    @property
+    def cash(self): # -> Price available for buying, None if not limited
+        return None
     def buy(self, product, amount):
         raise NotImplementedError
+    # buyable indexed by asset class, rebuilt when buyable changes
+    _catalog = None
+
+    @property
+    def catalog(self):
+        buyable = self.buyable
+        if self._catalog is None or self._catalog.source is not buyable:
+            self._catalog = Catalog(buyable)
+        return self._catalog
+
     def buy_aclass(self, aclass, price):
         debug(f"Provider {self.name} buy_aclass {aclass} for {price}")
-        debug(f"Provider {self.name} buyable products: {self.buyable}")
-        product = None
-        for p in self.buyable:
-            if p.aclass == aclass:
-                product = p
-                break
+        product, amount = self.catalog.best(aclass, price)
         if product is None:
             debug(f"Provider {self.name} buy_aclass: product not found for aclass {aclass}")
             return (None, None)
-        debug(f"Provider {self.name} buy_aclass found product {product}")
-        amount = price.num / get_rate(product.price.unit, price.unit) / product.price.num
-        debug(f"buy_aclass: computing amount: {price.num:.2f} / {get_rate(product.price.unit, price.unit):.2f} / {product.price.num:.2f} = {amount:.8f}")
+        debug(f"Provider {self.name} buy_aclass found product {product}, amount {amount}")
         assert(amount >= 0)
+        if amount == 0:
+            return (product, amount)
 
         return (product, self.buy(product, amount))
 
+    @staticmethod
+    def spent(product, amount, currency):
+        """
+        Money paid in currency for amount of product including spread and
+        fees, rounded down so it never exceeds what was asked for
+        """
+        if not amount:
+            return money.Money(0, currency)
+        return money.Money.of(
+                (amount * Catalog.cost(product) + Decimal(product.other.get("order_fee", 0)))
+                    * get_rate(product.price.unit, currency),
+                currency,
+                rounding=money.ROUND_DOWN,
+            )
+
     def buy_real_portfolio(self, portfolio):
         debug(f"buy_real_portfolio: provider {self.name}, portfolio to buy {portfolio}")
         currency = portfolio.currency
@@ -139,33 +238,51 @@ class Provider(ABC):
             bought_product, bought_amount = self.buy_aclass(ac, Price(amount, currency))
             if bought_product is None:
                 continue
-            if not bought_amount:
-                bought_amount = 0.0
-            bought_amount = float(bought_amount)
+            bought_amount = Decimal(bought_amount or 0)
             debug(f"buy_real_portfolio: provider {self.name}, tried to buy {ac} {amount:.2f}, bought {bought_amount}")
-            #total_bought += bought_amount
-            total_bought += RealPortfolio(
-                values={ ac: Decimal(bought_amount)*bought_product.price.num },
-                currency=bought_product.price.unit
-            )
+            value = self.spent(bought_product, bought_amount, currency)
+            total_bought += RealPortfolio(values={ac: value}, currency=currency)
             debug2(f"buy_real_portfolio: provider {self.name}, total_bought step {total_bought}")
         debug(f"buy_real_portfolio: provider {self.name}, total_bought {total_bought}")
         return total_bought # what was bought
 
 
 class AbstractPortfolio:
+    @classmethod
+    def from_dict(cls, *, d):
+        debug(f"from_dict: {d}")
+        assert d["class"] == cls.__name__
+        return cls(
+                values={
+                    ac: Decimal(str_dec) for ac, str_dec in d["values"].items()
+                },
+            )
+
+    def to_dict(self):
+        return {
+                "class": self.__class__.__name__,
+                "values": {
+                        ac: str(dec) for ac, dec in self._values.items()
+                    }
+            }
+
+    # cached, values never change
+    _ratios = None
+
     def __init__(self, *, values={}):
         self._values = values
         self._total = sum(values.values())
 
     @property
     def ratios(self):
-        values = self._values
-        total = self._total
-        ratios = {}
-        for k, val in values.items():
-            ratios[k] = val / total
-        return ratios
+        if self._ratios is None:
+            values = self._values
+            total = self._total
+            ratios = {}
+            for k, val in values.items():
+                ratios[k] = val / total
+            self._ratios = ratios
+        return self._ratios
 
     def __str__(self):
         return " | ".join([f"{ac}: {ratio:.2f}"
@@ -177,16 +294,21 @@ class AbstractPortfolio:
 
 
 class RealPortfolio:
+    """
+    Values per asset class in `currency`, kept exactly as integer counts
+    of the currency's smallest unit (see money.places).
+    """
     @classmethod
     def from_assets(cls, *, assets, currency):
         values = {}
-        for a in assets:
+        converted = convert(
+                [a.amount * a.product.price.num for a in assets],
+                [a.product.price.unit for a in assets],
+                currency,
+            )
+        for a, value in zip(assets, converted):
             aclass = a.product.aclass
-            values[aclass] = values.get(aclass, Decimal(0)) + Decimal(
-                    a.amount
-                    * a.product.price.num
-                    * get_rate(a.product.price.unit, currency)
-                )
+            values[aclass] = values.get(aclass, Decimal(0)) + value
             assert values[aclass] >= 0
         return RealPortfolio(currency=currency, values=values)
 
@@ -208,7 +330,7 @@ class RealPortfolio:
                 "class": self.__class__.__name__,
                 "currency": self._currency,
                 "values": {
-                        ac: str(dec) for ac, dec in self._values.items()
+                        ac: str(dec) for ac, dec in self.values.items()
                     }
             }
 
@@ -217,13 +339,22 @@ class RealPortfolio:
         if type(currency) is not str or len(currency) != 3:
             error(f"RealPortfolio: bad currency {currency}")
         self._currency = currency.lower()
-
-        if values is None:
-            self._values = {}
+        self._places = money.places(self._currency)
+
+        # aclass -> int, rounded half-even to the currency's smallest unit
+        self._units = {}
+        if values is not None:
+            for ac, v in values.items():
+                units = money.to_units(v, self._places, unit=self._currency)
+                assert units >= 0
+                self._units[ac] = units
+
+    def __setstate__(self, state):
+        # pickled before values were kept as integers
+        if "_values" in state:
+            self.__init__(values=state["_values"], currency=state["_currency"])
         else:
-            self._values = values
-            for v in values.values():
-                assert v >= 0
+            self.__dict__.update(state)
 
     def _add_asset(self, a):
         return NotImplementedError()
@@ -246,42 +377,61 @@ class RealPortfolio:
         else:
             self._add_asset(a)
 
+    # cached, dropped whenever values change
+    _values = None
+    _total = None
+    _ratios = None
+
+    def _changed(self):
+        self._values = None
+        self._total = None
+        self._ratios = None
+
     def remove(self, ac):
-        if ac in self._values:
+        if ac in self._units:
             debug2(f"RealPortfolio: removing {ac} from {self}")
-            del self._values[ac]
+            del self._units[ac]
+            self._changed()
             debug2(f"RealPortfolio: removed {ac} from {self}")
 
+    def _other_units(self, other, rounding):
+        """other's values as our units, converted with explicit rounding"""
+        if other.currency == self.currency:
+            return other._units
+        rate = get_rate(other.currency, self.currency)
+        return {
+                ac: money.to_units(v * rate, self._places, rounding=rounding)
+                for ac, v in other.values.items()
+            }
 
     def __iadd__(self, other):
         debug(f"RealPortfolio +=: other {other}")
-        rate = get_rate(other.currency, self.currency)
-        for ac, ov in other.values.items():
-            assert ov >= 0
-            self._values[ac] = self._values.get(ac, Decimal(0)) + ov*rate
+        for ac, ou in self._other_units(other, money.ROUND_HALF_EVEN).items():
+            assert ou >= 0
+            self._units[ac] = self._units.get(ac, 0) + ou
+        self._changed()
         return self
 
     def __isub__(self, other):
         # TODO what to do with self.assets?
-        for oc, ov in other.values.items():
-            if oc not in self.values:
+        # other in another currency is rounded down, never taking away more
+        # than it is worth
+        for oc, ou in self._other_units(other, money.ROUND_DOWN).items():
+            if oc not in self._units:
                 error(f"RealPortfolio: -= not possible for {oc}")
-            price = self.values[oc]
-            debug2(f"RealPortfolion: -= original price: {price}")
-            price -= ov * get_rate(other.currency, self.currency)
-            debug2(f"RealPortfolion: -= updated price: {price}")
-            if -PRECISION < price < 0.0:
-                debug2(f"RealPortfolion: -= price slightly negative: {price}")
-                price = Decimal(0)
-            assert price >= 0
-            self._values[oc] = price
+            units = self._units[oc] - ou
+            if units < 0:
+                error(f"RealPortfolio: -= {other} would make {oc} negative in {self}")
+            self._units[oc] = units
+        self._changed()
         return self
 
     def __mul__(self, other):
         m = Decimal(other)
         assert m >= 0
-        for k,v in self._values.items():
-            self._values[k] = m * v
+        for k, u in self._units.items():
+            self._units[k] = money.to_units(m * u, 0)
+        self._changed()
         return self
 
     __rmul__ = __mul__
@@ -295,31 +445,40 @@ class RealPortfolio:
         return NotImplementedError()
         #return self._assets
 
-    # returns { aclass -> num }
+    def amount(self, ac):
+        return money.Money(self._units.get(ac, 0), self._currency)
+
+    # returns { aclass -> Decimal }, read-only
     @property
     def values(self):
+        if self._values is None:
+            places = self._places
+            self._values = {
+                    ac: money.to_decimal(u, places) for ac, u in self._units.items()
+                }
         return self._values
 
     @property
     def total(self):
-        return sum(self._values.values())
+        if self._total is None:
+            self._total = money.to_decimal(sum(self._units.values()), self._places)
+        return self._total
 
     @property
     def ratios(self):
-        values = self.values
-        total = self.total
-        assert total >= 0
-        ratios = {}
-        for aclass, val in values.items():
-            assert val >= 0
-            ratios[aclass] = val / total
-        return ratios
+        if self._ratios is None:
+            total = sum(self._units.values())
+            ratios = {}
+            for aclass, units in self._units.items():
+                ratios[aclass] = Decimal(units) / total
+            self._ratios = ratios
+        return self._ratios
 
     def __str__(self):
-        return ( f"RealPortfolio({self.currency} {sum(self._values.values()):.2f}: "
+        return ( f"RealPortfolio({self.currency} {self.total:.2f}: "
             + (
-                " ".join(f"[{ac}: {v:.2f}]" for ac, v in self._values.items())
-                if self._values
+                " ".join(f"[{ac}: {v:.2f}]" for ac, v in self.values.items())
+                if self._units
                 else "empty"
               )
             #+ f", total {sum(self._values.values()):.2f}"
@@ -339,6 +498,9 @@ class RealPortfolio:
 class Strategy(ABC):
     strategies = []
 
+    # data sources used by action(), e.g. "history", "quotes"
+    requires = ()
+
     @classmethod
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -371,19 +533,61 @@ class Strategy(ABC):
         All values are relative.
         """
 
+    def action_batch(self, ideal, current, aclasses):
+        """
+        action() for many pairs at once: ideal and current are numpy
+        arrays (pairs x asset classes) of ratios over `aclasses`. Returns
+        allocation ratios of the same shape, rows summing to 1, or to 0
+        where there is nothing to buy. Calls action() for every row
+        unless a strategy has a native implementation.
+        """
+        import numpy as np
+        aclasses = list(aclasses)
+        result = np.zeros(np.shape(ideal))
+        for row, (i, c) in enumerate(zip(ideal, current)):
+            action = self.action(_abstract(aclasses, i), _abstract(aclasses, c))
+            if action is None:
+                continue
+            ratios = action.ratios
+            result[row] = [float(ratios.get(ac, 0)) for ac in aclasses]
+        return normalize_rows(result)
+
+def action_batch(strategy, ideal, current, aclasses):
+    """Strategy.action_batch(), also for strategies only registered with Strategy.register"""
+    batch = getattr(strategy, "action_batch", None)
+    if batch is None:
+        return Strategy.action_batch(strategy, ideal, current, aclasses)
+    return batch(ideal, current, aclasses)
+
+def _abstract(aclasses, ratios):
+    return AbstractPortfolio(values={
+            ac: Decimal(repr(float(r))) for ac, r in zip(aclasses, ratios) if r != 0
+        })
+
+def normalize_rows(allocation):
+    """Rows of allocation scaled to sum to 1, zero rows stay zero"""
+    import numpy as np
+    total = allocation.sum(axis=1, keepdims=True)
+    return np.divide(allocation, total, out=np.zeros_like(allocation), where=total > 0)
+
 class DCAStrategy(Strategy):
     def action(self, ideal, current):
         return deepcopy(ideal)
 
+    def action_batch(self, ideal, current, aclasses):
+        import numpy as np
+        return normalize_rows(np.array(ideal, dtype=np.float64))
+
 class MinRatioAssetStrategy(Strategy):
     def action(self, ideal, current):
         debug(f"MinRatioAssetStrategy: ideal {ideal}")
         debug(f"MinRatioAssetStrategy: current {current}")
         aclass = None
         min_ratio = Decimal(2) # 200%
+        current_ratios = current.ratios
         # get the most underweight asset class
         for ac, ideal_ratio in ideal.ratios.items():
-            current_ratio = current.ratios.get(ac, Decimal(0))
+            current_ratio = current_ratios.get(ac, Decimal(0))
             ratio = current_ratio / Decimal(ideal_ratio) # TODO why is Decimal(ideal_value) needed?
             if ratio < min_ratio:
                 aclass = ac
@@ -393,8 +597,23 @@ class MinRatioAssetStrategy(Strategy):
         # spend all on this asset
         return AbstractPortfolio(values={aclass: Decimal(1)})
 
+    def action_batch(self, ideal, current, aclasses):
+        import numpy as np
+        ideal = np.asarray(ideal, dtype=np.float64)
+        current = np.asarray(current, dtype=np.float64)
+        # classes not in ideal never count, ties go to the first class
+        ratio = np.divide(current, ideal, out=np.full(ideal.shape, np.inf), where=ideal > 0)
+        rows = np.arange(len(ratio))
+        best = ratio.argmin(axis=1)
+        result = np.zeros(ideal.shape)
+        result[rows, best] = ratio[rows, best] < 2 # 200%
+        return result
+
 class UnderperformStrategy(Strategy):
+    requires = ("history", "quotes")
+
     def action(self, ideal, current):
+        from . import history # slow to import, only needed here
         acs = ("stock", "gold")
         
         ratios = {}
@@ -406,4 +625,11 @@ class UnderperformStrategy(Strategy):
 
         return AbstractPortfolio(values=ratios)
 
+    def action_batch(self, ideal, current, aclasses):
+        import numpy as np
+        # depends on history only, the same for every pair
+        ratios = self.action(None, None).ratios
+        row = np.array([float(ratios.get(ac, 0)) for ac in aclasses])
+        return normalize_rows(np.tile(row, (len(ideal), 1)))
+
 
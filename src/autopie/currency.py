@@ -1,29 +1,162 @@
-import requests
+import json
+import os
+import time
 from decimal import Decimal
 from .util import *
+from . import util
+from . import transport
 
+URL = "https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1/currencies/{base}.min.json"
+
+# rates younger than TTL seconds are used without asking the network
+TTL = 12 * 60 * 60
+# never touch the network, serve last known rates
+OFFLINE = False
+CACHE_FILE = None
+# the only base downloaded, all other pairs are derived from it
+PIVOT = "eur"
+
+# base -> {"timestamp": <unix time>, "rates": {quote -> rate},
+#          "etag": ..., "last_modified": ...}
 cache = {}
+_matrix = None
 
-def get_rate(base, quote):
-    debug2(f"get_rate: converting {base} to {quote}")
-    global cache
-    base = base.strip().lower()
-    quote = quote.strip().lower()
+class RateMatrix:
+    """Exchange rates between any two currencies derived from one pivot"""
+
+    def __init__(self, pivot, rates):
+        self.pivot = pivot
+        # units of currency per one pivot unit
+        self._rates = {
+            unit: Decimal(str(rate)) for unit, rate in rates.items() if rate
+        }
+        self._rates[pivot] = Decimal(1)
+
+    def _pivot_rate(self, unit):
+        rate = self._rates.get(unit, None)
+        if rate is None:
+            error(f"get_rate: no rate for '{unit}' (pivot '{self.pivot}')")
+        return rate
+
+    def rate(self, base, quote):
+        if base == quote:
+            return Decimal(1)
+        return self._pivot_rate(quote) / self._pivot_rate(base)
+
+    def convert(self, amounts, from_units, to_unit):
+        """Convert amounts[i] in from_units[i] to to_unit"""
+        to_unit = to_unit.strip().lower()
+        to_rate = self._pivot_rate(to_unit)
+        factors = {}
+        result = []
+        for amount, unit in zip(amounts, from_units):
+            factor = factors.get(unit, None)
+            if factor is None:
+                u = unit.strip().lower()
+                factor = Decimal(1) if u == to_unit else to_rate / self._pivot_rate(u)
+                factors[unit] = factor
+            result.append(amount * factor)
+        return result
+
+def init(cache_file=None, ttl=None, offline=False, pivot=None):
+    global CACHE_FILE, TTL, OFFLINE, PIVOT, cache, _matrix
+    if cache_file is None:
+        cache_file = os.path.join(util.data_dir(), "rates.json")
+    CACHE_FILE = cache_file
+    if ttl is not None:
+        TTL = int(ttl)
+    OFFLINE = bool(offline)
+    if pivot is not None:
+        PIVOT = pivot.strip().lower()
+    debug(f"currency: cache file {CACHE_FILE}, ttl {TTL}, offline {OFFLINE}, pivot {PIVOT}")
+    cache = _read_cache(CACHE_FILE)
+    _matrix = None
 
-    if base not in cache:
-        debug2(f"get_rate: base {base} not in cache, retrieving")
-        url = f"https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1/currencies/{base}.min.json"
+def _read_cache(file):
+    if not os.path.exists(file):
+        debug(f"currency: cache file {file} does not exist")
+        return {}
+    try:
+        with open(file, mode="r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        warn(f"currency: cannot read cache file {file}: {e}")
+        return {}
+    debug2(f"currency: read cache for bases {list(data)}")
+    return data
 
-        resp = requests.get(url=url)
-        if resp.status_code not in [200]:
-            return None
+def _fetch(base, entry):
+    """Return (rates, validators), rates None if not available"""
+    url = URL.format(base=base)
+    debug2(f"currency: fetching {url}")
+    resp, validators = transport.get(url, validators=entry)
+    if resp is None:
+        return (None, None)
+    if resp.status_code == 304 and entry is not None:
+        debug2(f"currency: rates for base '{base}' not modified")
+        return (entry["rates"], validators)
+    if resp.status_code not in [200]:
+        debug(f"currency: request for base '{base}' returned {resp.status_code}")
+        return (None, None)
+    try:
+        data = resp.json()
+    except ValueError as e: # a truncated or garbled body
+        debug(f"currency: bad reply for base '{base}': {e}")
+        return (None, None)
+    rates = data.get(base, None) if isinstance(data, dict) else None
+    return (rates, validators)
 
-        data = resp.json().get(base, None)
-        if data is None:
+def _rates(base):
+    if CACHE_FILE is None:
+        init()
+
+    entry = cache.get(base, None)
+    age = None
+    if entry is not None:
+        age = time.time() - entry["timestamp"]
+        if OFFLINE or age < TTL:
+            debug2(f"currency: using stored rates for '{base}' ({age:.0f}s old)")
+            return entry["rates"]
+
+    if OFFLINE:
+        error(f"get_rate: offline and no stored rates for base '{base}'")
+
+    debug2(f"currency: base {base} not fresh in cache, retrieving")
+    rates, validators = _fetch(base, entry)
+    if rates is None:
+        if entry is None:
             error(f"get_rate: no currency data for base '{base}'")
-        cache[base] = data
+        # stale rates are better than no rates
+        warn(f"get_rate: cannot refresh rates for '{base}', using {age/3600:.1f} hours old ones")
+        return entry["rates"]
 
-    value = Decimal(cache.get(base, {}).get(quote, None))
+    cache[base] = {
+        "timestamp": time.time(),
+        "rates": rates,
+        "etag": validators.get("etag", None),
+        "last_modified": validators.get("last_modified", None),
+    }
+    try:
+        util.write_json(CACHE_FILE, cache)
+    except (OSError, TypeError, ValueError) as e:
+        warn(f"currency: cannot write cache {CACHE_FILE}: {e}")
+    return rates
+
+def matrix():
+    global _matrix
+    if _matrix is None:
+        _matrix = RateMatrix(PIVOT, _rates(PIVOT))
+    return _matrix
+
+def get_rate(base, quote):
+    debug2(f"get_rate: converting {base} to {quote}")
+    base = base.strip().lower()
+    quote = quote.strip().lower()
+
+    value = matrix().rate(base, quote)
     debug2(f"get_rate: 1{base} = {value:.2f}{quote}")
 
     return value
+
+def convert(amounts, from_units, to_unit):
+    return matrix().convert(amounts, from_units, to_unit)
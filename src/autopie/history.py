@@ -1,10 +1,16 @@
 from datetime import datetime
+from contextlib import contextmanager
 import os
 import importlib.resources
 import pandas as pd
 import yfinance as yf
 
 from .util import *
+from . import util
+from . import transport
+from . import quotes
+from .colstore import ColumnStore
+from .window import WindowIndex
 
 COLUMNS = {
     "stock": "^GSPC",
@@ -15,22 +21,26 @@ COLUMNS = {
 
 MAX_MONTHS = 240
 
+# binary store in the data directory, see colstore
+STORE_DIR = "history"
+
+# do not download missing values
+OFFLINE = False
+
 df = None
 data_dir = None
 data_file = None
+store = None
+# rows of df changed since the last write to store
+_dirty = set()
+# column -> WindowIndex, built on first use
+_indexes = {}
+# month answering as the last complete one, see as_of()
+_as_of = None
 
-def init(filename="history.csv"):
-    global data_file
-    data_file = filename
-
-    dirs = []
-
-    global data_dir
-    data_dir = os.environ.get("XDG_DATA_HOME", "~/.local/share")
-    data_dir = os.path.expanduser(f"{data_dir}/autopie")
-    dirs.append(data_dir)
-
-    dirs.append(str(importlib.resources.files() / "data"))
+def _import_csv(filename):
+    """One-time import of the csv from the data directory or the package"""
+    dirs = [data_dir, str(importlib.resources.files() / "data")]
 
     debug(f"history: searching data in {dirs}")
 
@@ -44,105 +54,225 @@ def init(filename="history.csv"):
     if not found:
         error(f"history: csv not found, filename {filename} dirs {dirs}")
 
-    global df
-    df = pd.read_csv(history_file)
+    info(f"history: importing {history_file}")
+    return pd.read_csv(history_file)
+
+def init(filename="history.csv", offline=False):
+    """Configure history, data are loaded on first use"""
+    global data_file, OFFLINE
+    data_file = filename
+    OFFLINE = offline
+
+    global data_dir
+    data_dir = util.data_dir()
+
+    global df, store, _dirty, _indexes
+    df = None
+    store = None
+    _dirty = set()
+    _indexes = {}
+
+def _load():
+    global df, store, _dirty
+    if df is not None:
+        return
+    if data_dir is None:
+        init()
+
+    debug(f"history: loading")
+    store = ColumnStore(os.path.join(data_dir, STORE_DIR))
+    if store.exists():
+        df = store.read(ints=("year", "month"))
+        _dirty = set()
+    else:
+        df = _import_csv(data_file)
+        _dirty = set(range(len(df)))
     debug2(f"history: dataframe {df}")
     debug2(f"history: read dataframe")
 
     # Add missing rows
     last_row = df.iloc[-1]
-    last_year = int(last_row["year"])
-    last_month = int(last_row["month"])
-    now = datetime.now()
-    this_year = now.year
-    this_month = now.month
-    debug(f"last {last_year}-{last_month}, this {this_year}-{this_month}")
-    assert(last_year <= this_year)
-    if last_year == this_year:
-        assert(last_month <= this_month)
-
-    to_add = pd.DataFrame([], columns=df.columns)
-    m = last_month
-    for y in range(last_year, this_year+1):
-        start_m = 1
-        if y == last_year:
-            start_m = last_month+1
-        end_m = 12
-        if y == this_year:
-            end_m = this_month-1
-        for m in range(start_m, end_m+1):
-            debug2(f"Empty row for year {y} month {m}")
-            row = pd.DataFrame([[y, m] + [None]*(len(df.columns)-2)], columns=df.columns)
-            debug(f"Row: {row}")
-            to_add = pd.concat([to_add, row], ignore_index=True)
-    if not to_add.empty:
-        df = pd.concat([df, to_add], ignore_index=True)
-
-    # fill missing values
+    last = pd.Period(year=int(last_row["year"]), month=int(last_row["month"]), freq="M")
+    this = pd.Period(datetime.now(), freq="M")
+    debug(f"last {last}, this {this}")
+    assert(last <= this)
+
+    # months between the last one present and the current one (exclusive)
+    missing = pd.period_range(last + 1, this - 1, freq="M")
+    if len(missing) > 0:
+        debug2(f"history: empty rows for {missing[0]} .. {missing[-1]}")
+        rows = pd.DataFrame({"year": missing.year, "month": missing.month})
+        rows = rows.reindex(columns=df.columns)
+        _dirty.update(range(len(df), len(df) + len(rows)))
+        df = pd.concat([df, rows], ignore_index=True)
+
+    if OFFLINE:
+        debug(f"history: offline, not downloading missing values")
+    else:
+        _backfill()
+
+def _backfill():
+    """
+    Fill missing values of recent months, one multi-ticker download per
+    contiguous range of months with missing values
+    """
     debug(f"history: setting missing values")
-    for column in COLUMNS.values():
-        ticker = column
-        debug2(f"history: column {column}")
-        for ri, data in df.iloc[-MAX_MONTHS:].iterrows():
-            if pd.isna(data[column]):
-                debug2(f"history: Null value for column {column} in row {ri}")
-                y = int(data["year"]) # WTF it tends to cast it to numpy.float64
-                m = int(data["month"])
-                if m == 12:
-                    yn = y + 1
-                    mn = 1
-                else:
-                    yn = y
-                    mn = m + 1
-                value = yf.Ticker(ticker).history(
-                            start=f"{y}-{m}-1",
-                            end=f"{yn}-{mn}-1",
-                            interval="1d")["Close"].mean()
-                value = round(value, 2)
-                debug2(f"history: going to set {column} {y}-{m} to {value} {type(value)}")
-                df.at[ri, column] = value
-                debug(f"history: set {column} {y}-{m} to {value} {type(value)}")
+    tickers = list(COLUMNS.values())
+    recent = df.iloc[-MAX_MONTHS:]
+    missing = recent[tickers].isna()
+    rows = recent.index[missing.any(axis=1)]
+    if len(rows) == 0:
+        debug2(f"history: no missing values")
+        return
 
+    # an old gap and a recent one must not download the years between
+    ranges = (pd.Series(rows).diff() != 1).cumsum()
+    for _, r in pd.Series(rows).groupby(ranges):
+        _backfill_rows(pd.Index(r), [t for t in tickers if missing.loc[r, t].any()])
 
-def stats(ac, freq="month", num=240, until="last"):
-    debug2(f"history: getting stats for {ac}")
+def _backfill_rows(rows, tickers):
+    """Download values of tickers for contiguous rows and fill missing ones"""
+    first = df.loc[rows[0]]
+    last = df.loc[rows[-1]]
+    start = pd.Period(year=int(first["year"]), month=int(first["month"]), freq="M")
+    end = pd.Period(year=int(last["year"]), month=int(last["month"]), freq="M") + 1
+    debug(f"history: downloading {tickers} {start}..{end}")
+    data = yf.download(
+        tickers,
+        start=start.start_time.strftime("%Y-%m-%d"),
+        end=end.start_time.strftime("%Y-%m-%d"),
+        interval="1d",
+        auto_adjust=True,
+        progress=False,
+        session=transport.session(),
+    )
+    close = data["Close"]
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+
+    monthly = close.groupby([close.index.year, close.index.month]).mean().round(2)
+    keys = pd.MultiIndex.from_arrays([
+        df.loc[rows, "year"].astype(int),
+        df.loc[rows, "month"].astype(int),
+    ])
+    fetched = monthly.reindex(index=keys, columns=tickers)
+    fetched.index = rows
+    before = df.loc[rows, tickers].isna()
+    df.loc[rows, tickers] = df.loc[rows, tickers].fillna(fetched)
+    changed = (before & df.loc[rows, tickers].notna()).any(axis=1)
+    _dirty.update(rows[changed.to_numpy()])
+    debug2(f"history: backfilled {df.loc[rows, ['year', 'month'] + tickers]}")
+
+def _index(column):
+    index = _indexes.get(column, None)
+    if index is None:
+        if column not in df.columns:
+            error(f"history: column {column} not present in columns {df.columns}")
+        index = WindowIndex(df["year"], df["month"], df[column])
+        _indexes[column] = index
+    return index
+
+@contextmanager
+def as_of(month):
+    """
+    Answer as if `month` ((year, month)) was the last complete month and
+    its price the current one, e.g. to replay strategies in backtests.
+    """
+    global _as_of
+    previous = _as_of
+    _as_of = (int(month[0]), int(month[1]))
+    try:
+        yield
+    finally:
+        _as_of = previous
+
+def _last_month():
+    if _as_of is not None:
+        return _as_of
+    now = datetime.now()
+    if now.month == 1:
+        return (now.year-1, 12)
+    return (now.year, now.month-1)
+
+def windows(ac, nums=(12, 60, 240), until="last", percentiles=()):
+    """
+    Return {num: {"mean", "min", "max", q...}} for windows of `num` months
+    ending with month `until` ((year, month) or "last" complete month).
+    Percentiles `q` (0-100) are included if asked for.
+    """
+    debug2(f"history: getting windows {nums} for {ac}")
     column = COLUMNS[ac]
-    if column not in df.columns:
-        error(f"history: column {column} for asset class {ac} not present in columns {df.columns}")
     if until == "last":
-        now = datetime.now()
-        year = now.year
-        month = now.month
-        if month == 1:
-            until = (year-1, 12)
-        else:
-            until = (year, month-1)
+        until = _last_month()
     assert(len(until) == 2)
     debug2(f"history: until: {until}")
 
-    end = df.loc[df["year"]==until[0]].loc[df["month"]==until[1]].index[0] + 1
-    start = end - num
+    _load()
+    index = _index(column)
+    end = index.end(until)
+    result = {}
+    for num in nums:
+        w = index.window(end, num)
+        if percentiles:
+            w.update(index.percentiles(end, num, percentiles))
+        result[num] = {k: round(v, 2) for k, v in w.items()}
+    debug(f"history: windows for {ac} until {until}: {result}")
+    return result
 
-    debug(f"Start: {start}")
-    debug(f"End: {end}")
-    debug(f"Rows: {df.iloc[start:end]}")
+def stats(ac, freq="month", num=240, until="last"):
+    debug2(f"history: getting stats for {ac}")
+    result = windows(ac, nums=(num,), until=until)[num]
     ticker = COLUMNS[ac]
-    current = yf.Ticker(ticker).get_fast_info()["lastPrice"]
-    result = {
-            "current": round(current, 2),
-            "mean": round(float(df.iloc[start:end][column].mean()), 2),
-            "min": round(float(df.iloc[start:end][column].min()), 2),
-            "max": round(float(df.iloc[start:end][column].max()), 2),
-    }
+    if _as_of is None:
+        result["current"] = quotes.price(ticker, tickers=COLUMNS.values())
+    else:
+        index = _index(ticker)
+        result["current"] = index.window(index.end(_as_of), 1)["mean"]
     debug(f"history: stats result for {ac}: {result}")
 
     return result
 
+def prices(acs, num=MAX_MONTHS, until="last"):
+    """
+    (months, array) of prices of asset classes `acs` for the last `num`
+    months until `until`, months as [(year, month)], array months x acs.
+    Leading months without all prices are left out, and trailing ones
+    if until is "last".
+    """
+    last = until == "last"
+    if last:
+        until = _last_month()
+    _load()
+    columns = [COLUMNS[ac] for ac in acs]
+    end = _index(columns[0]).end(until)
+    if last:
+        complete = df[columns].notna().all(axis=1).to_numpy()[:end]
+        if not complete.any():
+            error(f"history: no complete prices of {acs}")
+        trailing = end - (len(complete) - complete[::-1].argmax())
+        if trailing:
+            warn(f"history: no prices of {acs} for the last {trailing} months, ending earlier")
+            end -= trailing
+    rows = df.iloc[max(0, end - num):end]
+    values = rows[columns].to_numpy(dtype="float64")
+    complete = ~pd.isna(values).any(axis=1)
+    if not complete.any():
+        error(f"history: no complete prices of {acs} until {until}")
+    first = complete.argmax()
+    if not complete[first:].all():
+        error(f"history: prices of {acs} missing in {len(complete) - first - complete[first:].sum()} months")
+    months = list(zip(rows["year"].iloc[first:].astype(int), rows["month"].iloc[first:].astype(int)))
+    return (months, values[first:])
+
 def clean():
     debug2("history: cleanup start")
-    # save dataframe to data directory
-    if data_dir is not None and data_file is not None:
-        debug2(f"history: saving to {data_dir}/{data_file}")
-        df.to_csv(f"{data_dir}/{data_file}", index=False)
-        debug(f"history: saved to {data_dir}/{data_file}")
+    # save new and changed rows to data directory, if anything was loaded
+    if store is not None and df is not None:
+        if _dirty:
+            debug2(f"history: saving {len(_dirty)} rows to {store.path}")
+            store.write(df, sorted(_dirty))
+            _dirty.clear()
+            debug(f"history: saved to {store.path}")
+        else:
+            debug(f"history: nothing changed, not saving")
     debug2("history: cleanup finished")
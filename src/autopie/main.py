@@ -11,18 +11,23 @@ from copy import deepcopy
 import click
 from click_default_group import DefaultGroup
 import importlib.metadata
+from datetime import datetime
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
 
 from .core import AbstractPortfolio, RealPortfolio, Price, Provider, Strategy
 from .util import *
 
-# TODO discover and import all providers dynamically
-from .providers.offline import Offline
-from .providers.xtb_treasury import XTB
-from .providers.kraken import Kraken
-
 from .currency import get_rate
+from . import currency as rates
+from . import transport
 from . import storage
-from . import history
+from . import plugins
+from . import allocate
+
+# seconds for all providers to log in and load assets
+PROVIDER_TIMEOUT = 120
 
 # Design:
 # 1. get holdings
@@ -48,6 +53,13 @@ def substitute_secrets(secrets, data):
         debug(f"substitute_secrets: type of {data} is {type(data)}")
         return
 
+def find_class(registered, group, name):
+    """Class `name` among already `registered` ones or from entry points"""
+    for C in registered:
+        if C.__name__.lower() == name:
+            return C
+    return plugins.load(group, name)
+
 @click.group(cls=DefaultGroup, default='invest', default_if_no_args=True)
 def main():
     pass
@@ -56,15 +68,15 @@ def main():
 def version():
     print(importlib.metadata.version("autopie"))
 
-@main.command()
-@click.option(
+debug_option = click.option(
         "-d", "--debug", "debug_level",
         type=click.IntRange(min=0, max=2),
         default=0,
         show_default=True,
         help="Debug level",
     )
-@click.option(
+
+config_dir_option = click.option(
         "--config-dir",
         type=click.Path(file_okay=False),
         envvar="AUTOPIE_CONFDIR",
@@ -72,10 +84,8 @@ def version():
         show_default=True,
         help="Configuration directory",
     )
-def invest(debug_level, config_dir):
-    set_verbose(debug_level)
-    info(f"Debug: {debug_level}")
 
+def load_config(config_dir):
     debug(f"config dir {config_dir}")
     config_dir = os.path.expanduser(config_dir)
     debug(f"config dir expanded {config_dir}")
@@ -96,33 +106,89 @@ def invest(debug_level, config_dir):
         substitute_secrets(secrets, config)
         #debug(f"Config with secrets: {pformat(config)}")
 
-    history.init()
+    return config
 
-    data_dir = os.environ.get("XDG_DATA_HOME", "~/.local/share")
-    data_dir = os.path.expanduser(f"{data_dir}/autopie")
-    storage_file = os.path.join(data_dir, config.get("storage_file", "data.store"))
+JSON_STORAGE_FILE = "data.store"
+SQLITE_STORAGE_FILE = "data.sqlite"
+
+def init_storage(config):
+    backend = config.get("storage_backend", "json")
+    default_file = SQLITE_STORAGE_FILE if backend == "sqlite" else JSON_STORAGE_FILE
+    storage_file = os.path.join(data_dir(), config.get("storage_file", default_file))
     debug(f"Storage file: {storage_file}")
-    storage.init(storage_file)
+    storage.init(
+        storage_file,
+        backend=backend,
+        namespace=config.get("storage_namespace", None),
+        # a new SQLite store takes over values of the JSON one
+        previous=os.path.join(data_dir(), config.get("storage_import_file", JSON_STORAGE_FILE)),
+    )
 
-    debug(f"Available providers: {[P.__name__.lower() for P in Provider.providers]}")
-    debug(f"Configured providers: {[p.lower() for p in config['providers']]}")
+def _in_thread(name, fn, *args, **kwargs):
+    """Run fn in a daemon thread, a Future of its result"""
+    future = Future()
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e: # also SystemExit from error()
+            future.set_exception(e)
+    # daemon, a provider stuck past its timeout must not block exit
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
 
-    providers = []
+def _clean(provider):
+    """clean() of a provider which may not be fully initialized"""
+    try:
+        provider.clean()
+    except Exception as e:
+        debug(f"Provider {provider.name} cleanup failed: {e!r}")
+
+def init_providers(config):
+    """
+    Configured providers, initialized concurrently, each given
+    provider_timeout seconds (or timeout of its section) from its start.
+    Stops without trading if one fails or is not ready, the portfolio
+    would miss its holdings.
+    """
+    default_timeout = config.get("provider_timeout", PROVIDER_TIMEOUT)
+    pending = []
     for p in config["providers"]:
         provider_name = p.lower()
-        found = False
         debug(f"Searching for provider {provider_name}")
-        for P in Provider.providers:
-            if provider_name == P.__name__.lower():
-                found = True
-                provider = P() # TODO: init directly in __init__? maybe not so modules are usable
-                provider.init(**config["providers"][p]["data"])
-                providers.append(provider)
-                break
-        if not found:
+        P = find_class(Provider.providers, plugins.PROVIDERS, provider_name)
+        if P is None:
             error(f"Configured provider {p} not available")
+        provider = P() # TODO: init directly in __init__? maybe not so modules are usable
+        timeout = config["providers"][p].get("timeout", default_timeout)
+        future = _in_thread(f"init-{provider_name}", provider.init, **config["providers"][p]["data"])
+        pending.append((provider, future, timeout, time.monotonic() + timeout))
+
+    providers = []
+    missing = []
+    for provider, future, timeout, deadline in pending:
+        try:
+            future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            warn(f"Provider {provider.name} not ready in {timeout} s")
+            # logged out if it gets ready later
+            future.add_done_callback(lambda f, provider=provider: f.exception() is None and _clean(provider))
+            missing.append(provider.name)
+            continue
+        except BaseException as e:
+            warn(f"Provider {provider.name} failed: {e!r}")
+            _clean(provider)
+            missing.append(provider.name)
+            continue
+        debug(f"Provider {provider.name} ready")
+        providers.append(provider)
+    if missing:
+        for provider in providers:
+            _clean(provider)
+        error(f"Providers {missing} not available, not trading without their holdings")
+    return providers
 
-    # get strategies
+def load_strategies(config):
+    """Configured strategies and their total weight"""
     config_strategies = config.get("strategies", None)
     total_weight = Decimal(0)
     if config_strategies is None:
@@ -138,24 +204,75 @@ def invest(debug_level, config_dir):
         if "weight" not in s:
             error(f"No weight for strategy {strategy_name}")
         total_weight += Decimal(s["weight"])
-        strategy = None
-        for S in Strategy.strategies:
-            if S.__name__.lower() == strategy_name.lower():
-                debug2(f"Strategy {strategy_name} found")
-                strategy = S(**s)
-        if strategy is None:
+        S = find_class(Strategy.strategies, plugins.STRATEGIES, strategy_name.lower())
+        if S is None:
             error(f"Cannot find strategy")
-        strategies.append(strategy)
+        debug2(f"Strategy {strategy_name} found")
+        strategies.append(S(**s))
     if len(strategies) == 0:
         error(f"No strategies loaded")
     else:
         debug(f"Strategies loaded: {[s.name for s in strategies]}")
 
-    # get ideal portfolio
+    return (strategies, total_weight)
+
+def init_sources(config, strategies, offline):
+    """Set up data sources some strategy needs, history loads on first use"""
+    sources = set()
+    for strategy in strategies:
+        sources.update(strategy.requires)
+    debug(f"Data sources required by strategies: {sorted(sources)}")
+    # imported here, pandas and yfinance are slow to import
+    if "quotes" in sources:
+        from . import quotes
+        quotes.init(
+            ttl=config.get("quotes_ttl", None),
+            offline=offline or config.get("offline", False),
+        )
+    if "history" in sources:
+        from . import history
+        history.init(offline=offline or config.get("offline", False))
+    return sources
+
+def load_ideal(config):
     ip = config.get("ideal", {})
     if len(ip) == 0:
         error(f"No ideal portfolio set")
-    ideal = AbstractPortfolio(values=ip)
+    return AbstractPortfolio(values=ip)
+
+@main.command()
+@debug_option
+@config_dir_option
+@click.option(
+        "--offline",
+        is_flag=True,
+        default=False,
+        help="Use last known exchange rates and prices, do not download them",
+    )
+def invest(debug_level, config_dir, offline):
+    set_verbose(debug_level)
+    info(f"Debug: {debug_level}")
+
+    config = load_config(config_dir)
+
+    rates.init(
+        ttl=config.get("rates_ttl", None),
+        offline=offline or config.get("offline", False),
+        pivot=config.get("rates_pivot", None),
+    )
+
+    init_storage(config)
+
+    debug(f"Available providers: {plugins.names(plugins.PROVIDERS)}")
+    debug(f"Configured providers: {[p.lower() for p in config['providers']]}")
+
+    providers = init_providers(config)
+
+    strategies, total_weight = load_strategies(config)
+
+    sources = init_sources(config, strategies, offline)
+
+    ideal = load_ideal(config)
 
     assets = []
     for provider in providers:
@@ -195,21 +312,27 @@ def invest(debug_level, config_dir):
     portfolio_to_buy.remove("cash")
     debug(f"Portfolio to buy (cash removal): {portfolio_to_buy}")
     info(f"Portfolio to buy: {portfolio_to_buy}")
+    with storage.transaction():
+        storage.begin_run(currency)
+        storage.journal("plan", portfolio_to_buy)
 
     remains = deepcopy(portfolio_to_buy)
     total_bought = RealPortfolio(currency=currency)
-    for provider in providers:
-        debug2(f"Provider {provider.name} trying to buy {remains}")
-        bought = provider.buy_real_portfolio(remains)
+    orders, exact = allocate.plan(remains, providers)
+    info(f"Orders{'' if exact else ' (best found)'}: {orders}")
+    for provider, bought in allocate.execute(orders, providers, currency):
         debug2(f"Provider {provider.name} bought {bought}")
+        storage.journal("fill", bought, provider=provider.name)
         remains -= bought
         total_bought += bought
         debug2(f"After provider {provider.name} remains {remains}")
     debug(f"Storage: saving {remains}")
-    storage.save("remains", remains)
-    storage.save("original_real", original_real)
-    storage.save("original_abstract", original_abstract)
-    storage.save("ideal", ideal)
+    with storage.transaction():
+        storage.journal("remains", remains)
+        storage.save("remains", remains)
+        storage.save("original_real", original_real)
+        storage.save("original_abstract", original_abstract)
+        storage.save("ideal", ideal)
 
     # TODO warn? error? make more robust?
     debug(f"Wanted to buy: {portfolio_to_buy}")
@@ -220,9 +343,148 @@ def invest(debug_level, config_dir):
         debug2(f"Provider {provider.name} cleanup")
         provider.clean()
 
-    history.clean()
+    if "history" in sources:
+        from . import history
+        history.clean()
+    transport.clean()
+    storage.clean()
 
     return 0
 
+@main.command()
+@debug_option
+@config_dir_option
+@click.option(
+        "--since",
+        type=click.DateTime(formats=["%Y-%m-%d"]),
+        default=None,
+        help="Start date  [default: start of this year]",
+    )
+def report(debug_level, config_dir, since):
+    """Show how much was bought per asset class"""
+    set_verbose(debug_level)
+    config = load_config(config_dir)
+    init_storage(config)
+
+    if since is None:
+        since = datetime(datetime.now().year, 1, 1)
+    print(f"Bought since {since:%Y-%m-%d}:")
+    for curr, values in storage.bought(since=since.timestamp()).items():
+        for ac, amount in sorted(values.items()):
+            print(f"  {ac}: {amount:.2f} {curr}")
+    storage.clean()
+
+@main.command()
+@debug_option
+@config_dir_option
+@click.option(
+        "--months",
+        type=click.IntRange(min=2),
+        default=240,
+        show_default=True,
+        help="Number of months to replay",
+    )
+@click.option(
+        "--until",
+        type=click.DateTime(formats=["%Y-%m"]),
+        default=None,
+        help="Last month to replay  [default: last complete month]",
+    )
+@click.option("--spread", type=float, default=0.0, show_default=True, help="Relative bid/ask spread paid")
+@click.option("--fee", type=float, default=0.0, show_default=True, help="Relative fee paid")
+@click.option(
+        "--offline",
+        is_flag=True,
+        default=False,
+        help="Do not download missing history",
+    )
+def backtest(debug_level, config_dir, months, until, spread, fee, offline):
+    """Replay configured strategies over past months"""
+    set_verbose(debug_level)
+    config = load_config(config_dir)
+    strategies, _ = load_strategies(config)
+    ideal = load_ideal(config)
+
+    # imported here, numpy and pandas are slow to import
+    from . import history
+    from . import backtest as bt
+    history.init(offline=offline or config.get("offline", False))
+    fill = bt.SpreadFill(spread, fee) if spread or fee else bt.Fill()
+    result = bt.run(
+        strategies,
+        ideal,
+        months=months,
+        until="last" if until is None else (until.year, until.month),
+        fill=fill,
+    )
+    summary = result.summary()
+    first, last = result.months[0], result.months[-1]
+    print(f"Backtest {first[0]}-{first[1]:02d}..{last[0]}-{last[1]:02d} ({summary['months']} months), {result.index}, {fill}")
+    print(f"  invested:       {summary['invested']:.2f}")
+    print(f"  value:          {summary['value']:.2f}")
+    print(f"  return:         {summary['return']:.2%} ({summary['annual_return']:.2%} annually)")
+    print(f"  max drawdown:   {summary['max_drawdown']:.2%}")
+    print(f"  tracking error: {summary['tracking_error']:.2%}")
+    print(f"  ideal distance: {summary['ideal_distance']:.2%}")
+    history.clean()
+
+@main.command()
+@debug_option
+@config_dir_option
+@click.option("--paths", type=click.IntRange(min=1), default=10000, show_default=True, help="Number of simulated paths")
+@click.option("--horizon", type=click.IntRange(min=1), default=240, show_default=True, help="Months per path")
+@click.option(
+        "--method",
+        type=click.Choice(["bootstrap", "parametric"]),
+        default="bootstrap",
+        show_default=True,
+        help="Resample blocks of past months or draw from their distribution",
+    )
+@click.option("--block", type=click.IntRange(min=1), default=12, show_default=True, help="Months per bootstrap block")
+@click.option("--months", type=click.IntRange(min=2), default=240, show_default=True, help="Months of history to use")
+@click.option("--seed", type=int, default=None, help="Seed for reproducible results")
+@click.option("--workers", type=click.IntRange(min=1), default=None, help="Worker processes  [default: CPU count]")
+@click.option("--spread", type=float, default=0.0, show_default=True, help="Relative bid/ask spread paid")
+@click.option("--fee", type=float, default=0.0, show_default=True, help="Relative fee paid")
+@click.option(
+        "--offline",
+        is_flag=True,
+        default=False,
+        help="Do not download missing history and prices",
+    )
+def simulate(debug_level, config_dir, paths, horizon, method, block, months, seed, workers, spread, fee, offline):
+    """Distribution of outcomes of configured strategies over random paths"""
+    set_verbose(debug_level)
+    config = load_config(config_dir)
+    strategies, _ = load_strategies(config)
+    ideal = load_ideal(config)
+
+    # imported here, numpy and pandas are slow to import
+    from . import history
+    from . import backtest as bt
+    from . import simulate as sim
+    history.init(offline=offline or config.get("offline", False))
+    fill = bt.SpreadFill(spread, fee) if spread or fee else bt.Fill()
+    outcomes = sim.run(
+        strategies,
+        ideal,
+        paths=paths,
+        horizon=horizon,
+        months=months,
+        fill=fill,
+        method=method,
+        block=block,
+        seed=seed,
+        workers=workers,
+    )
+    print(f"Simulated {outcomes.count} paths of {horizon} months ({method}), {fill}")
+    qs = sim.PERCENTILES
+    print(f"  {'':15} {'mean':>8} " + " ".join(f"{f'p{q}':>8}" for q in qs))
+    for k, row in outcomes.summary(qs).items():
+        fmt = (lambda v: f"{v:8.2f}") if k == "multiple" else (lambda v: f"{v:8.2%}")
+        print(f"  {k:15} {fmt(row['mean'])} " + " ".join(fmt(row[q]) for q in qs))
+    history.clean()
+    transport.clean()
+
 # TODO:
 # * logging
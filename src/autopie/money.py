@@ -0,0 +1,111 @@
+from decimal import Decimal, ROUND_HALF_EVEN, ROUND_DOWN, ROUND_UP
+
+from .util import *
+
+# Exact money and quantities as integer counts of 10**-places.
+#
+# Rounding policies, always explicit where precision is lost:
+#   ROUND_HALF_EVEN  conversions and splitting (default)
+#   ROUND_DOWN       what may be spent or ordered, never more than available
+#   ROUND_UP         what is needed, e.g. cash to free for an order
+
+# decimal places of amounts per unit, DEFAULT_PLACES for others
+DEFAULT_PLACES = 2
+PLACES = {
+    "btc": 8,
+    "xbt": 8,
+    "eth": 8,
+}
+
+# decimal places of order quantities if a product does not say
+DEFAULT_QUANTITY_PLACES = 8
+
+def places(unit):
+    return PLACES.get(unit, DEFAULT_PLACES)
+
+def to_units(amount, places, rounding=ROUND_HALF_EVEN, unit=None):
+    """
+    Integer count of 10**-places in amount (Decimal, int, str, float or
+    Money, which must be in `unit`)
+    """
+    t = type(amount)
+    if t is int:
+        return amount * 10**places
+    if t is Money:
+        if amount.unit != unit:
+            error(f"to_units: {amount} is not in {unit}")
+        return amount.to(places, rounding=rounding)
+    if t is not Decimal:
+        # str() so that floats keep their shortest decimal form
+        amount = Decimal(str(amount))
+    return int(amount.scaleb(places).to_integral_value(rounding=rounding))
+
+def to_decimal(units, places):
+    return Decimal(units).scaleb(-places)
+
+def quantize(amount, places, rounding=ROUND_HALF_EVEN, unit=None):
+    """amount rounded to `places` decimal places, as Decimal"""
+    return to_decimal(to_units(amount, places, rounding=rounding, unit=unit), places)
+
+class Money:
+    """Exact amount of `unit`, stored as integer count of 10**-places(unit)"""
+    __slots__ = ("units", "unit", "places")
+
+    def __init__(self, units, unit):
+        self.units = units
+        self.unit = unit
+        self.places = places(unit)
+
+    @classmethod
+    def of(cls, amount, unit, rounding=ROUND_HALF_EVEN):
+        unit = unit.lower()
+        return cls(to_units(amount, places(unit), rounding=rounding, unit=unit), unit)
+
+    def to(self, places, rounding=ROUND_HALF_EVEN):
+        """Units at different number of places"""
+        if places >= self.places:
+            return self.units * 10**(places - self.places)
+        return to_units(self.decimal, places, rounding=rounding)
+
+    @property
+    def decimal(self):
+        return to_decimal(self.units, self.places)
+
+    def _same(self, other):
+        if not isinstance(other, Money) or other.unit != self.unit:
+            error(f"Money: cannot combine {self} with {other}")
+
+    def __add__(self, other):
+        self._same(other)
+        return Money(self.units + other.units, self.unit)
+
+    def __sub__(self, other):
+        self._same(other)
+        return Money(self.units - other.units, self.unit)
+
+    def mul(self, factor, rounding=ROUND_HALF_EVEN):
+        return Money.of(self.decimal * factor, self.unit, rounding=rounding)
+
+    def convert(self, unit, rate, rounding=ROUND_HALF_EVEN):
+        """Amount in `unit` with `rate` units per one of ours"""
+        return Money.of(self.decimal * rate, unit, rounding=rounding)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and (self.units, self.unit) == (other.units, other.unit)
+
+    def __lt__(self, other):
+        self._same(other)
+        return self.units < other.units
+
+    def __le__(self, other):
+        self._same(other)
+        return self.units <= other.units
+
+    def __hash__(self):
+        return hash((self.units, self.unit))
+
+    def __str__(self):
+        return f"{self.decimal}{self.unit}"
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,42 @@
+import importlib
+import importlib.metadata
+
+from .util import *
+
+# Providers and strategies are found through package entry points and
+# imported only when a configuration refers to them.
+
+PROVIDERS = "autopie.providers"
+STRATEGIES = "autopie.strategies"
+
+# used when autopie is not installed, e.g. run from the source tree
+BUILTIN = {
+    PROVIDERS: {
+        "offline": "autopie.providers.offline:Offline",
+        "xtb": "autopie.providers.xtb_treasury:XTB",
+        "kraken": "autopie.providers.kraken:Kraken",
+    },
+    STRATEGIES: {
+        "dcastrategy": "autopie.core:DCAStrategy",
+        "minratioassetstrategy": "autopie.core:MinRatioAssetStrategy",
+        "underperformstrategy": "autopie.core:UnderperformStrategy",
+    },
+}
+
+def names(group):
+    found = {ep.name.lower() for ep in importlib.metadata.entry_points(group=group)}
+    return sorted(found | set(BUILTIN[group]))
+
+def load(group, name):
+    """Return the class registered as `name` in `group`, None if there is none"""
+    name = name.lower()
+    for ep in importlib.metadata.entry_points(group=group):
+        if ep.name.lower() == name:
+            debug2(f"plugins: loading {group} {name} from {ep.value}")
+            return ep.load()
+    target = BUILTIN[group].get(name, None)
+    if target is None:
+        return None
+    debug2(f"plugins: loading builtin {group} {name} from {target}")
+    module, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module), attr)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import time
+from decimal import Decimal
 import krakenex
 
 from autopie.core import Provider, Product, Asset, Price
@@ -29,6 +30,9 @@ class Kraken(Provider):
     def clean(self):
         self._k.close()
 
+    # seconds for every request
+    TIMEOUT = 30
+
     ASSET_CLASSES = {
         "XXBT": "btc",
         "ZEUR": "cash",
@@ -42,7 +46,7 @@ class Kraken(Provider):
 
     def _refresh_assets(self):
         debug2(f"Querying: Balance")
-        data = self._k.query_private("Balance")
+        data = self._k.query_private("Balance", timeout=self.TIMEOUT)
         debug2(f"Returned: {data}")
         result = data.get("result", None)
         if result is None:
@@ -52,8 +56,8 @@ class Kraken(Provider):
         assets = []
         for k,v in result.items():
             debug(f"Kraken: processing balance {k}: {v}")
-            amount = float(v)
-            if amount == 0.0:
+            amount = Decimal(v)
+            if amount == 0:
                 debug2(f"Kraken: zero amount for {k}")
                 continue
             else:
@@ -75,23 +79,32 @@ class Kraken(Provider):
             elif ac == "btc":
                 pair = f"btc/{self._currency}"
                 debug2(f"Querying: Ticker {pair}")
-                data = self._k.query_public("Ticker", {"pair": f"{pair}"})
+                data = self._k.query_public("Ticker", {"pair": f"{pair}"}, timeout=self.TIMEOUT)
                 pairdata = data.get("result", {}).get(pair.upper(), None)
                 if pairdata is None:
                     error(f"cannot get Ticker data for {pair}")
 
                 debug2(f"Kraken Querying: AssetPairs {pair}")
-                data = self._k.query_public("AssetPairs", {"pair": pair})
+                data = self._k.query_public("AssetPairs", {"pair": pair}, timeout=self.TIMEOUT)
                 result = data.get("result", {})
                 if len(result) != 1:
                     error(f"Kraken: unexpected number of AssetPairs results for {pair}: {data}")
                 name = list(result.keys())[0]
-                ordermin = result[name]["ordermin"]
+                pairinfo = result[name]
+                ordermin = pairinfo["ordermin"]
                 debug(f"Kraken ordermin for {name}: {ordermin}")
-                other["ordermin"] = float(ordermin)
+                other["ordermin"] = Decimal(ordermin)
+                other["quantity_places"] = int(pairinfo["lot_decimals"])
+                # taker fee of the lowest volume tier in percent, market orders take
+                other["fee"] = Decimal(str(pairinfo["fees"][0][1])) / 100
+
+                ask = Decimal(pairdata["a"][0])
+                bid = Decimal(pairdata["b"][0])
+                mid = (ask + bid) / 2
+                other["spread"] = (ask - bid) / mid
 
                 price = Price(
-                        num=float(pairdata["a"][0]),
+                        num=mid,
                         unit=self._currency,
                         )
             else:
@@ -122,13 +135,23 @@ class Kraken(Provider):
     def buyable(self): # -> [ product ]
         return self._products
 
+    @property
+    def cash(self):
+        # only the quote currency of the pairs can be spent
+        currency = self._currency.lower()
+        total = Decimal(0)
+        for a in self._assets:
+            if a.product.aclass == "cash" and a.product.price.unit == currency:
+                total += a.amount
+        return Price(total, currency)
+
 
     def buy(self, product, amount):
         debug2(f"Kraken buying {amount} of {product}")
 
         ordermin = product.other["ordermin"]
         debug(f"Kraken minimum for {product.name}: {ordermin}")
-        if amount <= ordermin:
+        if amount < ordermin:
             debug(f"Cannot buy {amount:.8f} of {product.name}, minimum is {ordermin}")
             return 0.0
 
@@ -151,7 +174,7 @@ class Kraken(Provider):
             debug2(f"Buy loop: iteration {t}")
             t += 1
 
-            reply = self._k.query_private("AddOrder", buy_data)
+            reply = self._k.query_private("AddOrder", buy_data, timeout=self.TIMEOUT)
             debug2(f"Kraken AddOrder returned: {reply}")
             err = reply["error"]
 
@@ -16,10 +16,10 @@ class Offline(Provider):
                 product=Product(
                     name=asset["name"],
                     aclass=asset["aclass"],
-                    price=Price(float(asset["price"]), asset["currency"]),
+                    price=Price(Decimal(str(asset["price"])), asset["currency"]),
                     provider=self._name
                     ),
-                amount=float(asset["amount"]),
+                amount=Decimal(str(asset["amount"])),
             )
             self._assets.append(a)
         
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import json
+import threading
+from concurrent.futures import Future, TimeoutError
+from websocket import create_connection, WebSocketConnectionClosedException
+
+from ..util import *
+
+# XTB API connections.
+#
+# XTBClient multiplexes commands on one websocket: every request carries a
+# customTag and a reader thread hands each reply to the future of its tag,
+# so many commands can be in flight. call() waits for the reply, acall()
+# awaits it from asyncio.
+#
+# XTBStream is the streaming channel of a logged in session: subscribed
+# tick prices and balance are pushed and kept as the latest values.
+#
+# The server drops connections, e.g. for commands sent too often. recv()
+# then returns an empty message instead of raising; that, and anything
+# that does not decode, closes the connection for the reader.
+
+def _receive(ws):
+    """Next decoded message, None once the connection is closed"""
+    try:
+        message = ws.recv()
+        if not message:
+            debug2("XTB: connection closed by the server")
+            return None
+        res = json.loads(message)
+        if not isinstance(res, dict):
+            raise ValueError(f"not an object: {message!r}")
+        return res
+    except Exception as e: # closed, by us or the server, or garbage
+        debug2(f"XTB: reader stopped: {e!r}")
+        return None
+
+def _closed(pending, reason):
+    while pending:
+        try:
+            _, future = pending.popitem()
+        except KeyError: # emptied meanwhile
+            break
+        if not future.done():
+            future.set_result((False, reason))
+
+class XTBClient:
+    def __init__(self, url, timeout, limiter):
+        self.timeout = timeout
+        self._limiter = limiter
+        self._ws = create_connection(url, timeout=timeout)
+        # replies come whenever, the reader waits without a timeout
+        self._ws.settimeout(None)
+        self._send_lock = threading.Lock()
+        self._pending = {} # customTag -> Future
+        self._tags = itertools.count(1)
+        self.closed = False
+        self._reader = threading.Thread(target=self._read, name="xtb-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            res = _receive(self._ws)
+            if res is None:
+                # before failing pending requests, see request()
+                self.closed = True
+                _closed(self._pending, "web socket closed")
+                self._ws.close()
+                return
+            future = self._pending.pop(res.get("customTag", None), None)
+            if future is None:
+                debug(f"XTBClient: reply without a request: {res}")
+                continue
+            if "streamSessionId" in res: # login
+                data = {"streamSessionId": res["streamSessionId"]}
+            elif res.get("status", False):
+                data = res.get("returnData", None)
+            else:
+                data = f"{res.get('errorCode', '')}: {res.get('errorDescr', '')}"
+            future.set_result((res.get("status", False), data))
+
+    def request(self, command, **args):
+        """Send command, a Future of (status, data)"""
+        tag = str(next(self._tags))
+        message = {"command": command, "customTag": tag}
+        if args:
+            message["arguments"] = args
+        future = Future()
+        self._pending[tag] = future
+        # the reader marks closed before failing pending requests,
+        # so either it fails this one or we see closed here
+        if self.closed:
+            self._pending.pop(tag, None)
+            future.set_result((False, "web socket closed"))
+            return future
+        self._limiter.acquire()
+        try:
+            with self._send_lock:
+                self._ws.send(json.dumps(message))
+        except (WebSocketConnectionClosedException, OSError):
+            self._pending.pop(tag, None)
+            future.set_result((False, "web socket closed"))
+        return future
+
+    def wait(self, future):
+        """(status, data) of a request"""
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            return (False, f"no reply in {self.timeout} s")
+
+    def call(self, command, **args):
+        """Send command and wait for (status, data)"""
+        return self.wait(self.request(command, **args))
+
+    async def acall(self, command, **args):
+        return await asyncio.wait_for(asyncio.wrap_future(self.request(command, **args)), self.timeout)
+
+    def close(self):
+        self._ws.close()
+        self._reader.join(self.timeout)
+
+class XTBStream:
+    def __init__(self, url, session_id, timeout):
+        self._session_id = session_id
+        self._ws = create_connection(url, timeout=timeout)
+        self._ws.settimeout(None)
+        self._send_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self.prices = {} # symbol -> (bid, ask)
+        self.balance = None # as in getMarginLevel
+        self.closed = False
+        self._reader = threading.Thread(target=self._read, name="xtb-stream", daemon=True)
+        self._reader.start()
+
+    def _send(self, command, **args):
+        with self._send_lock:
+            self._ws.send(json.dumps({"command": command, "streamSessionId": self._session_id, **args}))
+
+    def _read(self):
+        while True:
+            res = _receive(self._ws)
+            if res is None:
+                # pushed values stop being current
+                with self._changed:
+                    self.closed = True
+                    self.prices = {}
+                    self.balance = None
+                    self._changed.notify_all()
+                self._ws.close()
+                return
+            command = res.get("command", None)
+            data = res.get("data", {})
+            with self._changed:
+                if command == "tickPrices":
+                    # deeper levels of the order book are not the best price
+                    if data.get("level", 0) != 0:
+                        continue
+                    self.prices[data["symbol"]] = (data["bid"], data["ask"])
+                elif command == "balance":
+                    self.balance = data
+                else:
+                    debug2(f"XTBStream: ignoring {res}")
+                    continue
+                self._changed.notify_all()
+
+    def subscribe_prices(self, symbols):
+        for symbol in symbols:
+            self._send("getTickPrices", symbol=symbol, maxLevel=0)
+
+    def subscribe_balance(self):
+        self._send("getBalance")
+
+    def wait_for(self, predicate, timeout):
+        """Wait until predicate(stream) is true, False on timeout, None if closed"""
+        with self._changed:
+            done = self._changed.wait_for(lambda: self.closed or predicate(self), timeout)
+            return None if self.closed else done
+
+    def close(self):
+        self._ws.close()
+        self._reader.join(1)
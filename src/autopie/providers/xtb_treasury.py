@@ -1,60 +1,91 @@
 import json
+import os
+import re
+import tempfile
 import time
-from websocket import create_connection, WebSocketConnectionClosedException
 import pprint
 from math import ceil, floor
+from decimal import Decimal
 
 from ..currency import get_rate
+from ..money import Money, ROUND_UP
+from ..ratelimit import RateLimiter
 from ..core import Provider, Price, Product, Asset
 from ..util import *
+from .xtb_client import XTBClient, XTBStream
 
 class XTB(Provider):
-    @staticmethod
-    def _ws_mkcmd(command, **args):
-        data = {
-            "command": command,
-        }
-        if args:
-            data['arguments'] = {}
-            for (key, value) in args.items():
-                data['arguments'][key] = value
-        debug2(f"mkcmd data: {data}")
-        return data
-
     def _ws_send(self, command, **args):
         debug2(f"XTB _ws_send {command}: {args}")
-        dict_data = self._ws_mkcmd(command, **args)
-        time.sleep(0.2)
-        try:
-            self._ws.send(json.dumps(dict_data))
-            r = self._ws.recv()
-        except WebSocketConnectionClosedException:
-            return (False, "web socket closed")
-        res = json.loads(r)
-        debug2(f"ws_send res: {res}")
-        res_data = None
-        if 'returnData' in res.keys():
-            res_data = res['returnData']
-        return (res['status'], res_data)
+        status, data = self._client.call(command, **args)
+        debug2(f"ws_send res: {status} {data}")
+        return (status, data)
 
     def init(self, **data):
         debug2(f"Provider XTB({self.name}) init: {data}")
         ws = data.get("url", None)
         login = data.get("login", None)
         pw = data.get("password", None)
+        # e.g. wss://ws.xtb.com/demo -> wss://ws.xtb.com/demoStream
+        stream_url = data.get("stream_url", f"{ws}Stream" if ws else None)
 
         if any(elem is None for elem in (ws, login, pw)):
             raise ValueError("url, login and password needed")
 
-        self._ws = create_connection(ws)
-        status, data = self._ws_send("login", userId=login, password=pw)
-        debug2(f"login: {status} {data}")
-        # TODO die if login failed
-        self._get_currency()
-        self._refresh_assets()
+        self._url = ws
+        # also bounds every reply
+        self._limiter = RateLimiter(self.RATE, self.BURST)
+        self._client = XTBClient(ws, self.TIMEOUT, self._limiter)
+        self._stream = None
+        status, session = self._ws_send("login", userId=login, password=pw)
+        if not status:
+            self._client.close()
+            error(f"XTB {self.name} login failed: {session}")
+        # independent, in flight together
+        user = self._client.request("getCurrentUserData")
+        trades = self._client.request("getTrades", openedOnly=True)
+        self._refresh_assets(trades)
+        self._get_currency(user)
+        self._open_stream(stream_url, session["streamSessionId"])
+
+    def _open_stream(self, url, session_id):
+        """Have quotes of the products and the balance pushed"""
+        try:
+            self._stream = XTBStream(url, session_id, self.TIMEOUT)
+            self._stream.subscribe_prices(p.name for p in self._products)
+            self._stream.subscribe_balance()
+        except Exception as e:
+            warn(f"XTB {self.name}: no streaming from {url} ({e!r}), polling")
+            self._stream = None
+            return
+        debug(f"XTB {self.name}: streaming from {url}")
+
+    def _live_stream(self):
+        """The stream while it is connected, None when polling"""
+        stream = self._stream
+        if stream is None or stream.closed:
+            return None
+        return stream
 
     def clean(self):
+        if self._stream is not None:
+            self._stream.close()
         self._ws_send("logout")
+        self._client.close()
+        debug(f"XTB {self.name}: {self._limiter}")
+
+    # seconds to connect and wait for a reply
+    TIMEOUT = 30
+
+    # requests should be 200 ms apart, the connection is dropped after
+    # 6 requests in a row sent sooner
+    RATE = 5
+    BURST = 4
+
+    CASH_PRODUCT_NAME = "IB01.UK"
+
+    # no commission on stocks and ETFs below the monthly turnover limit
+    FEE = Decimal(0)
 
     _ASSET_CLASSES = {
         "VWRA.UK": "stock",
@@ -67,56 +98,135 @@ class XTB(Provider):
     def _symbol_aclass(cls, symbol):
         return cls._ASSET_CLASSES.get(symbol, "unknown")
 
-    def _get_currency(self):
-        status, data = self._ws_send("getCurrentUserData")
-        debug2(f"XTB buy getCurrentUserData sent {status} {data}")
-        if status:
-            ac = data.get("currency", None)
+    # static symbol data from getAllSymbols, cached in the data directory
+    # per server, refreshed after SYMBOLS_TTL seconds
+    SYMBOLS_FILE = "xtb-symbols.json"
+    SYMBOLS_TTL = 7 * 24 * 3600
+    SYMBOL_FIELDS = ("currency", "lotMin", "lotStep", "lotMax", "precision", "categoryName")
 
+    # some symbols are different in real and demo version,
+    # e.g., IGLN.UK / IGLN.UK_9
+    _ALIAS_SUFFIX = re.compile(r"_\d+$")
+
+    def _symbols(self):
+        """{symbol -> static data} of the server, cached"""
+        file = os.path.join(data_dir(), self.SYMBOLS_FILE)
+        cache = {}
+        try:
+            with open(file, "r") as fp:
+                cache = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            warn(f"XTB: ignoring unreadable symbol cache {file}: {e}")
+        entry = cache.get(self._url, None)
+        if entry is not None and time.time() - entry["timestamp"] < self.SYMBOLS_TTL:
+            debug(f"XTB: {len(entry['symbols'])} symbols from cache {file}")
+            return entry["symbols"]
+
+        status, data = self._ws_send("getAllSymbols")
+        if not status:
+            if entry is not None:
+                warn(f"XTB getAllSymbols failed ({data}), using symbols cached before")
+                return entry["symbols"]
+            error(f"XTB getAllSymbols: {data}")
+        symbols = {
+            r["symbol"]: {k: r.get(k, None) for k in self.SYMBOL_FIELDS} for r in data
+        }
+        debug(f"XTB: {len(symbols)} symbols from getAllSymbols")
+        cache[self._url] = {"timestamp": time.time(), "symbols": symbols}
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # unique, accounts may be initialized concurrently
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), prefix=".xtb-symbols")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmp, file)
+        return symbols
+
+    def _resolve(self, symbol, symbols):
+        """Name of symbol on this server, trying its aliases, or None"""
+        if symbol in symbols:
+            return symbol
+        base = self._ALIAS_SUFFIX.sub("", symbol)
+        if base in symbols:
+            return base
+        prefix = base + "_"
+        for name in symbols:
+            if name.startswith(prefix) and self._ALIAS_SUFFIX.fullmatch(name[len(base):]):
+                return name
+        return None
+
+    def _get_currency(self, user):
+        status, data = self._client.wait(user)
+        debug2(f"XTB buy getCurrentUserData sent {status} {data}")
+        ac = data.get("currency", None) if status else None
         if ac is None:
             error(f"XTB: cannot get account currency")
 
         self._account_currency = ac.strip().lower()
 
-    def _refresh_assets(self):
+    def _refresh_assets(self, trades):
         debug2(f"Provider XTB({self.name}) _refresh_assets")
         products = []
         assets = []
-        status, data = self._ws_send("getTrades", openedOnly=True)
+        # getAllSymbols, if not cached, goes out while waiting for getTrades
+        symbols = self._symbols()
+        status, data = self._client.wait(trades)
         debug2(f"XTB getTrades(openedOnly=True): {status}: {json.dumps(data, indent=4)}")
         if not status:
             error("XTB getTrades")
         pf_amounts = {}
         for r in data:
             symbol = r["symbol"]
-            pf_amounts[symbol] = pf_amounts.get(symbol, 0.0) + r["volume"]
+            # JSON numbers are floats, str() keeps their decimal form
+            pf_amounts[symbol] = pf_amounts.get(symbol, Decimal(0)) + Decimal(str(r["volume"]))
         debug2(f"XTB sum: {pprint.pformat(pf_amounts)}")
-        values = {}
         # move somewhere else?
         for symbol in self._ASSET_CLASSES:
             if symbol not in pf_amounts:
-                pf_amounts[symbol] = 0.0
+                pf_amounts[symbol] = Decimal(0)
+
+        # names on this server, with the asset class of the name asked for
+        amounts = {}
+        aclasses = {}
         for symbol, amount in pf_amounts.items():
-            status, data = self._ws_send("getSymbol", symbol=symbol)
-            if not status:
-                # some symbols are different in real and demo version,
-                # e.g., IGLN.UK / IGLN.UK_9; continue if not found
-                debug2(f"XTB getSymbol {symbol} not found (data: {data})")
+            name = self._resolve(symbol, symbols)
+            if name is None:
+                debug2(f"XTB symbol {symbol} not found")
                 continue
-            debug2(f"XTB getSymbol({symbol}): {pprint.pformat(data)}")
-            avg_price = (data["bid"]+data["ask"] ) / 2
-            currency = data["currency"]
+            amounts[name] = amounts.get(name, Decimal(0)) + amount
+            if aclasses.get(name, "unknown") == "unknown":
+                aclasses[name] = self._symbol_aclass(symbol)
+
+        # only prices change, all in one request
+        status, data = self._ws_send("getTickPrices", level=0, symbols=list(amounts), timestamp=0)
+        debug2(f"XTB getTickPrices: {status}: {pprint.pformat(data)}")
+        if not status:
+            error(f"XTB getTickPrices: {data}")
+        for quote in data["quotations"]:
+            name = quote["symbol"]
+            static = symbols[name]
+            bid = Decimal(str(quote["bid"]))
+            ask = Decimal(str(quote["ask"]))
+            avg_price = (bid + ask) / 2
+            currency = static["currency"]
             product=Product(
-                name=symbol,
-                aclass=self._symbol_aclass(symbol),
+                name=name,
+                aclass=aclasses[name],
                 price=Price(avg_price, currency),
-                provider=self._name
+                provider=self._name,
+                other={
+                    "spread": (ask - bid) / avg_price,
+                    "fee": self.FEE,
+                    "ordermin": Decimal(str(static["lotMin"] or 1)),
+                    "quantity_places": 0, # whole shares only
+                },
                 )
             products.append(product)
             assets.append(
                 Asset(
                     product=product,
-                    amount=amount,
+                    amount=amounts[name],
                 )
             )
         self._products = products
@@ -127,19 +237,66 @@ class XTB(Provider):
     def buyable(self):
         return self._products
 
+    @property
+    def cash(self):
+        # free cash and what the cash product can be sold for
+        free_cash = self._get_free_cash()
+        if free_cash is None:
+            return None
+        for a in self._assets:
+            if a.product.name == self.CASH_PRODUCT_NAME:
+                free_cash += a.amount * self._price(a.product) * get_rate(a.product.price.unit, self._account_currency)
+        return Price(free_cash, self._account_currency)
+
     def _get_free_cash(self):
+        stream = self._live_stream()
+        balance = stream.balance if stream is not None else None
+        if balance is not None:
+            return Decimal(str(balance["balance"]))
         status, data = self._ws_send("getMarginLevel")
         debug2(f"XTB buy getMarginLevel sent {status} {data}")
         if status:
-            return data.get("balance", None)
+            balance = data.get("balance", None)
+            if balance is not None:
+                return Decimal(str(balance))
 
         return None
 
+    def _price(self, product):
+        """Latest pushed mid price of product, else the one of refresh"""
+        stream = self._live_stream()
+        quote = stream.prices.get(product.name, None) if stream is not None else None
+        if quote is None:
+            return product.price.num
+        bid, ask = quote
+        return (Decimal(str(bid)) + Decimal(str(ask))) / 2
+
+    def _wait_free_cash(self, need_cash, wait_cycles, wait_time):
+        """Wait until free cash covers need_cash, True if it does"""
+        stream = self._live_stream()
+        if stream is not None and stream.balance is not None:
+            covered = stream.wait_for(
+                    lambda stream: Decimal(str(stream.balance["balance"])) >= need_cash,
+                    wait_cycles * wait_time,
+                )
+            if covered is not None:
+                return covered
+            warn(f"XTB {self.name}: streaming stopped, polling")
+        for i in range(wait_cycles):
+            debug2(f"XTB buy: waiting iteration {i}")
+            free_cash = self._get_free_cash()
+            debug2(f"XTB buy: waiting free_cash: {free_cash:.2f}")
+            if free_cash >= need_cash:
+                return True
+            if i < wait_cycles-1:
+                time.sleep(wait_time)
+        return False
+
     def _sell(self, product, amount):
         debug2(f"XTB selling {amount} of {product}")
         tti = {
             "cmd": 1, # SELL
-            "price": float(product.price.num),
+            "price": float(self._price(product)),
             "symbol": product.name,
             "type": 0, # OPEN
             "volume": float(amount)
@@ -178,22 +335,26 @@ class XTB(Provider):
             debug(f"XTB: not buying zero amount")
             return 0.0
 
+        price = self._price(product)
         free_cash = self._get_free_cash()
-        need_cash = float(amount * product.price.num * get_rate(product.price.unit, self._account_currency))
+        need_cash = Money.of(
+                amount * price * get_rate(product.price.unit, self._account_currency),
+                self._account_currency,
+                rounding=ROUND_UP,
+            ).decimal
         if free_cash < need_cash:
             debug(f"XTB buy needs more cash: free cash {free_cash:.2f}, need {need_cash:.2f}")
-            # need to sell IB02.UK
-            CASH_PRODUCT_NAME="IB01.UK"
+            # need to sell IB01.UK
             cash_product = None
             for p in self._products:
-                if p.name == CASH_PRODUCT_NAME:
+                if p.name == self.CASH_PRODUCT_NAME:
                     cash_product = p
                     break
             if cash_product is None:
                 error(f"XTB buy error: cash product not found")
             sell_amount = ceil(
-                    (need_cash-free_cash)*1.1
-                    / float(cash_product.price.num*get_rate(cash_product.price.unit, self._account_currency))
+                    (need_cash-free_cash) * Decimal("1.1")
+                    / (self._price(cash_product)*get_rate(cash_product.price.unit, self._account_currency))
                 )
             res = self._sell(cash_product, sell_amount)
             if not res:
@@ -202,23 +363,17 @@ class XTB(Provider):
             debug2(f"XTB buy: successfully sold {sell_amount} of {cash_product.name}")
             # let's wait for the free cash
             debug2(f"XTB buy: waiting for free_cash > need_cash {need_cash:.2f}")
-            for i in range(wait_cycles):
-                debug2(f"XTB buy: waiting iteration {i}")
-                free_cash = self._get_free_cash()
-                debug2(f"XTB buy: waiting free_cash: {free_cash:.2f}")
-                if free_cash >= need_cash:
-                    debug2(f"XTB buy: free_cash is available")
-                    break
+            if self._wait_free_cash(need_cash, wait_cycles, wait_time):
+                debug2(f"XTB buy: free_cash is available")
+            else:
                 debug2(f"XTB buy: free_cash not yet available")
-                if i < wait_cycles-1:
-                    time.sleep(wait_time)
         tti = {
             "cmd": 0, # BUY
             #"customComment": f"buying {amount} of {product.name} ",
             #"expiration": None,
             #"offset": 0,
             #"order": 0,
-            "price": float(product.price.num),
+            "price": float(price),
             #"sl": 0.0,
             "symbol": product.name,
             #"tp": 0.0,
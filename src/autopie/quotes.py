@@ -0,0 +1,99 @@
+import json
+import os
+import time
+import pandas as pd
+import yfinance as yf
+
+from .util import *
+from . import util
+from . import transport
+
+# last prices of tickers, downloaded in one batch and shared by all users
+
+# snapshot younger than TTL seconds is used without asking the network
+TTL = 15 * 60
+OFFLINE = False
+CACHE_FILE = None
+
+# {"timestamp": <unix time>, "prices": {ticker -> price}}
+snapshot = None
+
+def init(cache_file=None, ttl=None, offline=False):
+    global CACHE_FILE, TTL, OFFLINE, snapshot
+    if cache_file is None:
+        cache_file = os.path.join(util.data_dir(), "quotes.json")
+    CACHE_FILE = cache_file
+    if ttl is not None:
+        TTL = int(ttl)
+    OFFLINE = bool(offline)
+    debug(f"quotes: cache file {CACHE_FILE}, ttl {TTL}, offline {OFFLINE}")
+    snapshot = None
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE, mode="r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            warn(f"quotes: cannot read cache file {CACHE_FILE}: {e}")
+
+def _fetch(tickers):
+    debug(f"quotes: downloading {tickers}")
+    try:
+        data = yf.download(
+            tickers,
+            period="5d",
+            interval="1d",
+            auto_adjust=True,
+            progress=False,
+            session=transport.session(),
+        )
+    except Exception as e:
+        debug(f"quotes: download failed: {e}")
+        return None
+    close = data["Close"]
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+    if close.empty:
+        return None
+    # today's daily bar follows the last trade
+    last = close.ffill().iloc[-1]
+    return {
+        t: round(float(last[t]), 2) for t in tickers
+        if t in last.index and not pd.isna(last[t])
+    }
+
+def price(ticker, tickers=()):
+    """
+    Return last price of `ticker`.
+    Snapshot is refreshed for `ticker` and `tickers` together.
+    """
+    global snapshot
+    if CACHE_FILE is None:
+        init()
+
+    fresh = snapshot is not None and (
+        OFFLINE or time.time() - snapshot["timestamp"] < TTL
+    )
+    if fresh and ticker in snapshot["prices"]:
+        debug2(f"quotes: {ticker} from snapshot")
+        return snapshot["prices"][ticker]
+
+    if OFFLINE:
+        error(f"quotes: offline and no stored price for {ticker}")
+
+    wanted = sorted(set(tickers) | {ticker})
+    if snapshot is not None:
+        wanted = sorted(set(wanted) | set(snapshot["prices"]))
+    prices = _fetch(wanted)
+    if prices is None or ticker not in prices:
+        if snapshot is None or ticker not in snapshot["prices"]:
+            error(f"quotes: cannot get price for {ticker}")
+        age = time.time() - snapshot["timestamp"]
+        warn(f"quotes: cannot refresh {ticker}, using {age/60:.0f} minutes old price")
+        return snapshot["prices"][ticker]
+
+    snapshot = {"timestamp": time.time(), "prices": prices}
+    try:
+        util.write_json(CACHE_FILE, snapshot)
+    except (OSError, TypeError, ValueError) as e:
+        warn(f"quotes: cannot write cache {CACHE_FILE}: {e}")
+    return prices[ticker]
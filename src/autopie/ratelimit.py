@@ -0,0 +1,50 @@
+import threading
+import time
+
+from .util import *
+
+class RateLimiter:
+    """
+    Token bucket: up to `burst` requests at once, `rate` per second on
+    average. acquire() sleeps only when no token is left; callers waiting
+    at the same time are served in turn. Counts requests and the time
+    spent throttled.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = clock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_time = 0.0
+
+    def acquire(self):
+        """Take a token, waiting for it if needed, returns seconds waited"""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.requests += 1
+            # goes below zero while callers wait, each reserves its token
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            wait = -self._tokens / self.rate
+            self.throttled += 1
+            self.throttled_time += wait
+        debug2(f"RateLimiter: waiting {wait:.3f} s")
+        self._sleep(wait)
+        return wait
+
+    def __str__(self):
+        return (f"RateLimiter({self.rate:g}/s, burst {self.burst}: {self.requests} requests, "
+                f"{self.throttled} throttled for {self.throttled_time:.2f} s)")
+
+    def __repr__(self):
+        return str(self)
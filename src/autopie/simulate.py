@@ -0,0 +1,224 @@
+import os
+from math import ceil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+import numpy as np
+
+from .util import *
+from .core import action_batch, normalize_rows
+from .vector import AClassIndex
+from .backtest import Fill
+
+# Monte Carlo simulation of strategies over random return paths built from
+# the monthly history: bootstrap (blocks of consecutive historical months)
+# or parametric (multivariate normal log returns with historical mean and
+# covariance). Every month `contribution` is allocated like in invest and
+# the portfolio grows with the path's returns. Strategies needing data
+# sources (e.g. history) keep their allocation as of the last month.
+#
+# Paths are split into shards of SHARD_PATHS, each with its own RNG stream
+# spawned from one seed, so results do not depend on the number of
+# workers. Shards run in a process pool reading the historical returns
+# from shared memory. Each shard only returns histograms of the outcomes
+# (fixed bins, see BINS), which are merged into percentiles.
+
+SHARD_PATHS = 2000
+# paths simulated together in one shard, bounds memory
+CHUNK = 500
+
+METHODS = ("bootstrap", "parametric")
+
+# outcome -> bin edges, values outside are counted in the first/last bin
+BINS = {
+    # final value / money invested
+    "multiple": np.geomspace(0.01, 100, 4001),
+    # time-weighted, annualized
+    "annual_return": np.linspace(-1, 1, 4001),
+    "max_drawdown": np.linspace(-1, 0, 2001),
+}
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+class _Fixed:
+    """Allocation of a strategy computed once, for workers without its data"""
+
+    def __init__(self, row):
+        self.row = row
+
+    def action_batch(self, ideal, current, aclasses):
+        return np.tile(self.row, (len(ideal), 1))
+
+class Outcomes:
+    """Streamed aggregates of outcomes: count, sum and histogram each"""
+
+    def __init__(self):
+        self.count = 0
+        self.sums = {k: 0.0 for k in BINS}
+        self.hists = {k: np.zeros(len(edges) - 1, dtype=np.int64) for k, edges in BINS.items()}
+
+    def add(self, outcomes):
+        self.count += len(next(iter(outcomes.values())))
+        for k, values in outcomes.items():
+            edges = BINS[k]
+            self.sums[k] += float(values.sum())
+            bins = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+            self.hists[k] += np.bincount(bins, minlength=len(edges) - 1)
+
+    def merge(self, other):
+        self.count += other.count
+        for k in BINS:
+            self.sums[k] += other.sums[k]
+            self.hists[k] += other.hists[k]
+
+    def mean(self, k):
+        return self.sums[k] / self.count
+
+    def percentile(self, k, q):
+        """Percentile q (0-100), interpolated within its bin"""
+        edges = BINS[k]
+        cumulative = np.cumsum(self.hists[k])
+        target = q / 100 * self.count
+        i = min(int(np.searchsorted(cumulative, target)), len(cumulative) - 1)
+        below = cumulative[i - 1] if i else 0
+        inside = self.hists[k][i]
+        fraction = (target - below) / inside if inside else 0.0
+        return float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+
+    def summary(self, qs=PERCENTILES):
+        return {
+            k: {"mean": self.mean(k), **{q: self.percentile(k, q) for q in qs}}
+            for k in BINS
+        }
+
+def _paths(rng, returns, n, horizon, method, block):
+    """Returns of n paths, array paths x months x asset classes"""
+    months = len(returns)
+    if method == "bootstrap":
+        block = min(block, months)
+        blocks = ceil(horizon / block)
+        starts = rng.integers(0, months - block + 1, size=(n, blocks))
+        rows = (starts[:, :, np.newaxis] + np.arange(block)).reshape(n, -1)[:, :horizon]
+        return returns[rows]
+    logs = np.log1p(returns)
+    draws = rng.multivariate_normal(logs.mean(axis=0), np.cov(logs, rowvar=False), size=(n, horizon))
+    return np.expm1(draws)
+
+def _simulate(paths, strategies, weights, ideal, index, contribution, fill):
+    """Outcomes of paths (paths x months x asset classes)"""
+    n, horizon, width = paths.shape
+    ideal_rows = np.tile(ideal, (n, 1))
+    values = np.zeros((n, width))
+    invested = np.zeros(n)
+    growth = np.ones(n)
+    peak = np.ones(n)
+    drawdown = np.zeros(n)
+    ones = np.ones(width)
+    for t in range(horizon):
+        allocation = np.zeros((n, width))
+        current = normalize_rows(values)
+        for strategy, weight in zip(strategies, weights):
+            allocation += weight * action_batch(strategy, ideal_rows, current, index)
+        values += fill(ones, allocation * contribution)
+        invested += allocation.sum(axis=1) * contribution
+
+        before = values.sum(axis=1)
+        values *= 1 + paths[:, t]
+        after = values.sum(axis=1)
+        growth *= np.divide(after, before, out=np.ones(n), where=before > 0)
+        np.maximum(peak, growth, out=peak)
+        np.minimum(drawdown, growth / peak - 1, out=drawdown)
+    return {
+        "multiple": np.divide(values.sum(axis=1), invested, out=np.zeros(n), where=invested > 0),
+        "annual_return": growth ** (12 / horizon) - 1,
+        "max_drawdown": drawdown,
+    }
+
+def _shard(task):
+    """Worker: simulate one shard, its Outcomes"""
+    (shm_name, shape, seed, n, horizon, method, block,
+        strategies, weights, ideal, aclasses, contribution, fill) = task
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        returns = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        rng = np.random.default_rng(seed)
+        index = AClassIndex(aclasses)
+        outcomes = Outcomes()
+        for start in range(0, n, CHUNK):
+            paths = _paths(rng, returns, min(CHUNK, n - start), horizon, method, block)
+            outcomes.add(_simulate(paths, strategies, weights, ideal, index, contribution, fill))
+        return outcomes
+    finally:
+        del returns
+        shm.close()
+
+def run(strategies, ideal, *, paths=10000, horizon=240, months=240, until="last",
+        contribution=1.0, fill=None, method="bootstrap", block=12, seed=None, workers=None):
+    """
+    Simulate `strategies` (weighted like in invest) toward `ideal`
+    (AbstractPortfolio) over `paths` paths of `horizon` months, built from
+    `months` months of history until `until`. Returns Outcomes.
+    """
+    # here only, workers do not need pandas
+    from . import history
+    if method not in METHODS:
+        error(f"simulate: unknown method {method}, known {METHODS}")
+    if fill is None:
+        fill = Fill()
+    acs = [ac for ac in ideal.ratios if ac in history.COLUMNS]
+    skipped = [ac for ac in ideal.ratios if ac not in history.COLUMNS and ac != "cash"]
+    if skipped:
+        warn(f"simulate: no history for {skipped}, leaving them out")
+    if not acs:
+        error(f"simulate: no history for any of {list(ideal.ratios)}")
+    month_list, prices = history.prices(acs, num=months, until=until)
+    returns = prices[1:] / prices[:-1] - 1
+    if "cash" in ideal.ratios:
+        acs.append("cash")
+        returns = np.column_stack((returns, np.zeros(len(returns))))
+    index = AClassIndex(acs)
+    ideal_vector = normalize_rows(index.vector({ac: ideal.ratios[ac] for ac in acs})[np.newaxis])[0]
+
+    total_weight = sum(s.weight for s in strategies)
+    weights = [float(s.weight / total_weight) for s in strategies]
+    # strategies needing data sources are evaluated here, once, as of the
+    # last month of history
+    portable = []
+    for strategy in strategies:
+        requires = getattr(strategy, "requires", ())
+        if requires:
+            warn(f"simulate: {strategy.name} uses {', '.join(requires)}, keeping its allocation of {month_list[-1][0]}-{month_list[-1][1]:02d} in all months")
+            with history.as_of(month_list[-1]):
+                row = action_batch(strategy, ideal_vector[np.newaxis], np.zeros((1, len(index))), index)[0]
+            strategy = _Fixed(row)
+        portable.append(strategy)
+
+    shards = ceil(paths / SHARD_PATHS)
+    seeds = np.random.SeedSequence(seed).spawn(shards)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, shards))
+    debug(f"simulate: {paths} paths of {horizon} months, {method}, {len(returns)} months of {index}, {shards} shards, {workers} workers")
+
+    shm = shared_memory.SharedMemory(create=True, size=returns.nbytes)
+    try:
+        shared = np.ndarray(returns.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = returns
+        tasks = [
+            (shm.name, returns.shape, s, min(SHARD_PATHS, paths - i * SHARD_PATHS), horizon, method, block,
+                portable, weights, ideal_vector, index.aclasses, contribution, fill)
+            for i, s in enumerate(seeds)
+        ]
+        outcomes = Outcomes()
+        if workers == 1:
+            results = map(_shard, tasks)
+            for result in results:
+                outcomes.merge(result)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                for result in pool.map(_shard, tasks):
+                    outcomes.merge(result)
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return outcomes
@@ -5,23 +5,383 @@ import sys
 import json
 import pickle
 import codecs
+import fcntl
+import io
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from decimal import Decimal
 from .util import *
+from .core import RealPortfolio, AbstractPortfolio
+from .money import Money
 
 VERSION = 1
 STORAGE = None
 
-def init(storage_path):
+class Storage(ABC):
+    """
+    Key-value store plus an optional journal of runs.
+    Saves inside transaction() are committed when the outermost
+    transaction ends, saves outside of transactions right away.
+    With a namespace, keys (and journal) are private to one account,
+    so several accounts can share one store. A key missing in the
+    namespace is read from before namespaces were used, saving it then
+    moves it into the namespace.
+    """
+
+    def __init__(self, path, namespace=None):
+        self.path = path
+        self.namespace = namespace
+        self._depth = 0
+        # keys read from outside the namespace, moved when saved
+        self._adopted = set()
+
+    @abstractmethod
+    def open(self):
+        """Open or create the store"""
+    @abstractmethod
+    def _get(self, key):
+        """Return wrapped value stored under key, None if there is none"""
+    @abstractmethod
+    def _put(self, key, wrapped):
+        """Store wrapped value, not committed yet"""
+    @abstractmethod
+    def _delete(self, key):
+        """Remove key, not committed yet"""
+    @abstractmethod
+    def commit(self):
+        """Make changes durable"""
+    @abstractmethod
+    def _rollback(self):
+        """Discard uncommitted changes"""
+
+    def _key(self, key):
+        if self.namespace is None:
+            return key
+        return f"{self.namespace}/{key}"
+
+    def load(self, key):
+        debug(f"storage: load: key: {key}")
+        value = self._get(self._key(key))
+        if value is None and self.namespace is not None:
+            value = self._get(key)
+            if value is not None:
+                warn(f"storage: no {key} in namespace {self.namespace}, using the one stored"
+                    " without a namespace, saving moves it into the namespace")
+                self._adopted.add(key)
+        debug2(f"storage: load: wrapped value: {value}")
+        if value is not None:
+            value = _unwrap(value)
+            debug(f"storage: load: value: {value}")
+        return value
+
+    def save(self, key, value):
+        debug(f"storage: save: {key} -> {value}")
+        self._put(self._key(key), _wrap(value))
+        if key in self._adopted:
+            self._delete(key)
+        if self._depth == 0:
+            self.commit()
+
+    @contextmanager
+    def transaction(self):
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                debug(f"storage: transaction failed, discarding changes")
+                self._rollback()
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self.commit()
+
+    # journal of runs, backends without one ignore it
+    def begin_run(self, currency):
+        debug2(f"storage: {self.__class__.__name__} keeps no journal")
+    def journal(self, kind, portfolio, provider=None):
+        pass
+    def bought(self, since=None, aclass=None):
+        error(f"storage: {self.__class__.__name__} keeps no journal, use sqlite backend")
+
+    def close(self):
+        pass
+
+class JSONStorage(Storage):
+    """
+    Store in a JSON file read once and kept in memory.
+    Commit writes a temporary file and renames it over the store,
+    so the file is always complete. Reads hold a shared and commits an
+    exclusive lock on <path>.lock; a commit re-reads the file and only
+    applies keys changed by this process, so concurrent runs do not
+    lose each other's values.
+    """
+
+    def __init__(self, path, namespace=None):
+        super().__init__(path, namespace=namespace)
+        self._data = None
+        # key -> wrapped value (None when deleted), not committed yet
+        self._changed = {}
+        self._lockfd = None
+
+    @contextmanager
+    def _locked(self, mode):
+        fcntl.flock(self._lockfd, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lockfd, fcntl.LOCK_UN)
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if _file_format(self.path) == "sqlite":
+            error(f"storage: {self.path} is an SQLite database, set storage_backend = \"sqlite\"")
+        self._lockfd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        # if storage file does not exist, create it
+        if not os.path.exists(self.path):
+            with self._locked(fcntl.LOCK_EX):
+                if not os.path.exists(self.path):
+                    debug(f"Storage: {self.path} does not exist, creating")
+                    _write_file(self.path, {"version": VERSION, "store": {}})
+        with self._locked(fcntl.LOCK_SH):
+            self._data = _read_file(self.path)
+
+    def _get(self, key):
+        return self._data["store"].get(key, None)
+
+    def _put(self, key, wrapped):
+        self._data["store"][key] = wrapped
+        self._changed[key] = wrapped
+
+    def _delete(self, key):
+        self._data["store"].pop(key, None)
+        self._changed[key] = None
+
+    def commit(self):
+        if not self._changed:
+            debug2(f"storage: nothing to commit")
+            return
+        with self._locked(fcntl.LOCK_EX):
+            # other processes may have committed since we read the file
+            data = _read_file(self.path)
+            for key, wrapped in self._changed.items():
+                if wrapped is None:
+                    data["store"].pop(key, None)
+                else:
+                    data["store"][key] = wrapped
+            _write_file(self.path, data)
+        self._data = data
+        self._changed = {}
+
+    def _rollback(self):
+        if self._changed:
+            self._changed = {}
+            with self._locked(fcntl.LOCK_SH):
+                self._data = _read_file(self.path)
+
+    def close(self):
+        if self._lockfd is not None:
+            os.close(self._lockfd)
+            self._lockfd = None
+
+class SQLiteStorage(Storage):
+    """
+    Store in an SQLite database, with an append-only journal of runs:
+    what was planned, bought (fills) and what remained, per asset class.
+    SQLite does the locking, the database is in WAL mode so readers do
+    not block the writer.
+    """
+
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS store (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            time REAL NOT NULL,
+            currency TEXT NOT NULL,
+            account TEXT
+        );
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY,
+            run INTEGER NOT NULL REFERENCES runs(id),
+            time REAL NOT NULL,
+            kind TEXT NOT NULL,
+            aclass TEXT NOT NULL,
+            amount TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            provider TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_time ON runs(time);
+        CREATE INDEX IF NOT EXISTS journal_time ON journal(kind, time);
+        CREATE INDEX IF NOT EXISTS journal_aclass ON journal(aclass, kind, time);
+        CREATE TRIGGER IF NOT EXISTS journal_no_update BEFORE UPDATE ON journal
+            BEGIN SELECT RAISE(ABORT, 'journal is append-only'); END;
+        CREATE TRIGGER IF NOT EXISTS journal_no_delete BEFORE DELETE ON journal
+            BEGIN SELECT RAISE(ABORT, 'journal is append-only'); END;
+    """
+    # seconds to wait for other processes holding the database
+    TIMEOUT = 60
+
+    def __init__(self, path, namespace=None, previous=None):
+        super().__init__(path, namespace=namespace)
+        # JSON store a new database starts with
+        self.previous = previous
+        self._db = None
+        self._run = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if _file_format(self.path) == "json":
+            error(f"storage: {self.path} is a JSON store, set storage_backend = \"json\""
+                " or storage_file to a new file and storage_import_file to this one")
+        created = not os.path.exists(self.path)
+        if created:
+            debug(f"Storage: {self.path} does not exist, creating")
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        # a current schema is only read, not to wait for other writers
+        if version == self.SCHEMA_VERSION:
+            return
+        if version > self.SCHEMA_VERSION:
+            error(f"storage: {self.path} schema {version} is newer than supported {self.SCHEMA_VERSION}")
+        if version == 1:
+            debug(f"storage: upgrading {self.path} schema 1 -> 2")
+            self._db.execute("ALTER TABLE runs ADD COLUMN account TEXT")
+        self._db.executescript(self.SCHEMA)
+        self._db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        if created and self.previous is not None and _file_format(self.previous) == "json":
+            self._import(self.previous)
+        self._db.commit()
+
+    def _import(self, path):
+        """
+        Start with the values (of all namespaces) of JSON store path,
+        values without a namespace go into ours unless it has them
+        """
+        store = _read_file(path)["store"]
+        info(f"storage: importing {len(store)} values from {path} into {self.path}")
+        for key, wrapped in store.items():
+            if "/" not in key and self._key(key) not in store:
+                key = self._key(key)
+            self._put(key, wrapped)
+
+    def _get(self, key):
+        row = self._db.execute("SELECT value FROM store WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _put(self, key, wrapped):
+        self._db.execute(
+            "INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)",
+            (key, json.dumps(wrapped)),
+        )
+
+    def _delete(self, key):
+        self._db.execute("DELETE FROM store WHERE key = ?", (key,))
+
+    def commit(self):
+        debug2(f"storage: commit {self.path}")
+        self._db.commit()
+
+    def _rollback(self):
+        self._db.rollback()
+
+    def begin_run(self, currency):
+        cur = self._db.execute(
+            "INSERT INTO runs (time, currency, account) VALUES (?, ?, ?)",
+            (time.time(), currency.lower(), self.namespace),
+        )
+        self._run = cur.lastrowid
+        debug(f"storage: run {self._run} started")
+        if self._depth == 0:
+            self.commit()
+
+    def journal(self, kind, portfolio, provider=None):
+        """Append values of RealPortfolio as `kind` ("plan", "fill", "remains")"""
+        assert self._run is not None
+        debug(f"storage: journal {kind} {portfolio} {provider}")
+        now = time.time()
+        self._db.executemany(
+            "INSERT INTO journal (run, time, kind, aclass, amount, currency, provider)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (self._run, now, kind, ac, str(v), portfolio.currency, provider)
+                for ac, v in portfolio.values.items()
+                if v != 0
+            ],
+        )
+        if self._depth == 0:
+            self.commit()
+
+    def bought(self, since=None, aclass=None):
+        """Return {currency: {aclass: Decimal}} bought since unix time `since`"""
+        query = "SELECT aclass, amount, journal.currency FROM journal"
+        args = []
+        if self.namespace is not None:
+            query += " JOIN runs ON journal.run = runs.id AND runs.account = ?"
+            args.append(self.namespace)
+        query += " WHERE kind = 'fill'"
+        if aclass is not None:
+            query += " AND aclass = ?"
+            args.append(aclass)
+        if since is not None:
+            query += " AND journal.time >= ?"
+            args.append(since)
+        result = {}
+        for ac, amount, curr in self._db.execute(query, args):
+            values = result.setdefault(curr, {})
+            values[ac] = values.get(ac, Decimal(0)) + Decimal(amount)
+        return result
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+BACKENDS = {
+    "json": JSONStorage,
+    "sqlite": SQLiteStorage,
+}
+
+def init(storage_path, backend="json", namespace=None, previous=None):
+    """
+    Open the store, `previous` is a JSON store whose values a new SQLite
+    store is started with
+    """
     global STORAGE
 
-    STORAGE = storage_path
-    debug(f"Storage file: {STORAGE}")
+    debug(f"Storage file: {storage_path} ({backend}, namespace {namespace})")
+    if backend not in BACKENDS:
+        error(f"storage: unknown backend {backend}, available: {list(BACKENDS)}")
+    if backend == "sqlite":
+        STORAGE = SQLiteStorage(storage_path, namespace=namespace, previous=previous)
+    else:
+        STORAGE = BACKENDS[backend](storage_path, namespace=namespace)
+    STORAGE.open()
 
-    # if storage file does not exist, create it
-    if not os.path.exists(STORAGE):
-        debug(f"Storage: STORAGE {STORAGE} does not exist, creating")
-        os.makedirs(os.path.dirname(STORAGE), exist_ok=True)
-        os.mknod(STORAGE, mode=0o600)
-        _write_file(STORAGE, {"version": VERSION, "store": {}})
+def _file_format(path):
+    """"json", "sqlite", None for a missing or empty file, "unknown" otherwise"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except FileNotFoundError:
+        return None
+    if not head:
+        return None
+    if head == b"SQLite format 3\0":
+        return "sqlite"
+    if head.lstrip().startswith(b"{"):
+        return "json"
+    return "unknown"
 
 def _read_file(file):
     with open(file, mode="r", encoding="utf-8") as f:
@@ -31,30 +391,65 @@ def _read_file(file):
 
 def _write_file(file, data):
     debug(f"storage: writing to {file}: {data}")
-    with open(file, mode="w", encoding="utf-8") as f:
+    tmp = f"{file}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, mode="w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, file)
+    # make the rename itself durable
+    dirfd = os.open(os.path.dirname(os.path.abspath(file)), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+# type name -> (class, version, encode, decode)
+TYPES = {}
+_TYPE_NAMES = {}
+
+def register_type(cls, name, encode, decode, version=1):
+    """
+    Store instances of cls as {"type": name, "version": version,
+    "data": encode(obj)}; encode must return JSON data,
+    decode(data, version) must accept all versions up to `version`.
+    """
+    TYPES[name] = (cls, version, encode, decode)
+    _TYPE_NAMES[cls] = name
 
 def _wrap(data):
     debug2(f"storage: _wrap: {data}")
-    # try json.dumps
-    try:
-        _ = json.dumps(data)
-        # data is json-dumpable
+    name = _TYPE_NAMES.get(type(data), None)
+    if name is not None:
+        _, version, encode, _ = TYPES[name]
         return {
-                "type": "json",
-                "data": data,
+                "type": name,
+                "version": version,
+                "data": encode(data),
             }
-    except TypeError:
-        # data not json-dumpable
-        pass
 
-    # pickle and encode in base64
+    # plain data, must be json-dumpable
+    try:
+        _ = json.dumps(data)
+    except TypeError:
+        error(f"storage: cannot store {type(data)}, register it with register_type()")
     return {
-            "type": "b64pickle",
-            "data": codecs.encode(pickle.dumps(data), "base64").decode(),
-            ".str": str(data),
+            "type": "json",
+            "data": data,
         }
 
+class _Unpickler(pickle.Unpickler):
+    """Old stores pickled portfolios, allow nothing but registered types"""
+
+    def find_class(self, module, name):
+        if module == "decimal" and name == "Decimal":
+            return Decimal
+        for cls, _, _, _ in TYPES.values():
+            if cls.__module__ == module and cls.__name__ == name:
+                return cls
+        raise pickle.UnpicklingError(f"storage: {module}.{name} not allowed")
+
 def _unwrap(data):
     debug2(f"storage: _unwrap: {data}")
     if not all(key in data for key in ("type", "data")):
@@ -63,27 +458,63 @@ def _unwrap(data):
         case "json":
             return data["data"]
         case "b64pickle":
-            return pickle.loads(codecs.decode(data["data"].encode(), "base64"))
+            raw = codecs.decode(data["data"].encode(), "base64")
+            return _Unpickler(io.BytesIO(raw)).load()
+        case name if name in TYPES:
+            _, version, _, decode = TYPES[name]
+            if data.get("version", 1) > version:
+                error(f"storage: {name} version {data['version']} is newer than supported {version}")
+            return decode(data["data"], data.get("version", 1))
         case _:
             return None
 
+register_type(
+    Decimal, "decimal",
+    encode=str,
+    decode=lambda data, version: Decimal(data),
+)
+register_type(
+    Money, "money",
+    encode=lambda m: {"units": m.units, "unit": m.unit},
+    decode=lambda data, version: Money(data["units"], data["unit"]),
+)
+register_type(
+    RealPortfolio, "real-portfolio",
+    encode=RealPortfolio.to_dict,
+    decode=lambda data, version: RealPortfolio.from_dict(d=data),
+)
+register_type(
+    AbstractPortfolio, "abstract-portfolio",
+    encode=AbstractPortfolio.to_dict,
+    decode=lambda data, version: AbstractPortfolio.from_dict(d=data),
+)
+
 def save(key, value):
     assert STORAGE is not None
-    debug(f"storage: save: {key} -> {value}")
-    data = _read_file(STORAGE)
-    data["store"][key] = _wrap(value)
-    _write_file(STORAGE, data)
+    STORAGE.save(key, value)
 
 def load(key):
     assert STORAGE is not None
-    debug(f"storage: load: key: {key}")
-    contents = _read_file(STORAGE)
-    debug2(f"storage: load: contents: {contents}")
-    data = contents["store"]
-    debug2(f"storage: load: data: {data}")
-    value = data.get(key, None)
-    debug2(f"storage: load: wrapped value: {value}")
-    if value is not None:
-        value = _unwrap(value)
-        debug(f"storage: load: value: {value}")
-    return value
+    return STORAGE.load(key)
+
+def transaction():
+    assert STORAGE is not None
+    return STORAGE.transaction()
+
+def begin_run(currency):
+    assert STORAGE is not None
+    STORAGE.begin_run(currency)
+
+def journal(kind, portfolio, provider=None):
+    assert STORAGE is not None
+    STORAGE.journal(kind, portfolio, provider=provider)
+
+def bought(since=None, aclass=None):
+    assert STORAGE is not None
+    return STORAGE.bought(since=since, aclass=aclass)
+
+def clean():
+    global STORAGE
+    if STORAGE is not None:
+        STORAGE.close()
+        STORAGE = None
@@ -0,0 +1,69 @@
+from .util import *
+
+# shared HTTP transport: one pooled keep-alive session for the whole run
+# requests is imported on first use to keep CLI start fast
+
+# (connect, read) in seconds
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_session = None
+
+def session():
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        debug2(f"transport: creating session")
+        retry = Retry(
+            total=RETRIES,
+            backoff_factor=BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=("GET", "HEAD"),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        s = requests.Session()
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        _session = s
+    return _session
+
+def get(url, validators=None):
+    """
+    GET url through the shared session.
+    `validators` ({"etag": ..., "last_modified": ...}) from a previous
+    response make the request conditional; the server then may answer
+    304 Not Modified and the caller reuses its stored body.
+    Return (response, validators), response is None if the request failed.
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag", None):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified", None):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    debug2(f"transport: GET {url} {headers}")
+    import requests
+    try:
+        resp = session().get(url, headers=headers, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        debug(f"transport: GET {url} failed: {e}")
+        return (None, validators)
+    debug2(f"transport: GET {url} returned {resp.status_code}")
+
+    if resp.status_code == 304:
+        return (resp, validators)
+    return (resp, {
+        "etag": resp.headers.get("ETag", None),
+        "last_modified": resp.headers.get("Last-Modified", None),
+    })
+
+def clean():
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
@@ -1,5 +1,8 @@
 
+import json
+import os
 import sys
+import tempfile
 
 VERBOSE = 0
 
@@ -27,6 +30,30 @@ def error(m):
     print(f"ERROR: {m}")
     sys.exit(1)
 
+def data_dir():
+    d = os.environ.get("XDG_DATA_HOME", "~/.local/share")
+    return os.path.expanduser(f"{d}/autopie")
+
+def write_json(file, data):
+    """Write data to a JSON file, replaced whole so readers never see a partial one"""
+    debug2(f"writing {file}")
+    directory = os.path.dirname(file)
+    os.makedirs(directory, exist_ok=True)
+    # unique, runs sharing the data dir write the same files
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file)}.")
+    try:
+        with os.fdopen(fd, mode="w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, file)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
 def stop():
     print(f"STOP ... Execution halted for debugging purposes")
     sys.exit(100)
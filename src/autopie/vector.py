@@ -0,0 +1,44 @@
+import numpy as np
+
+from .util import *
+
+class AClassIndex:
+    """Fixed order of asset classes, asset class -> vector position"""
+
+    def __init__(self, aclasses):
+        self.aclasses = tuple(dict.fromkeys(aclasses))
+        self._positions = {ac: i for i, ac in enumerate(self.aclasses)}
+
+    def __len__(self):
+        return len(self.aclasses)
+
+    def __iter__(self):
+        return iter(self.aclasses)
+
+    def __contains__(self, ac):
+        return ac in self._positions
+
+    def __eq__(self, other):
+        return isinstance(other, AClassIndex) and self.aclasses == other.aclasses
+
+    def __hash__(self):
+        return hash(self.aclasses)
+
+    def position(self, ac):
+        pos = self._positions.get(ac, None)
+        if pos is None:
+            error(f"AClassIndex: unknown asset class {ac}, known {self.aclasses}")
+        return pos
+
+    def vector(self, values):
+        """float64 vector of {aclass -> value}, missing classes are zero"""
+        v = np.zeros(len(self.aclasses))
+        for ac, value in values.items():
+            v[self.position(ac)] = float(value)
+        return v
+
+    def __str__(self):
+        return f"AClassIndex({', '.join(self.aclasses)})"
+
+    def __repr__(self):
+        return str(self)
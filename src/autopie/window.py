@@ -0,0 +1,56 @@
+import numpy as np
+
+from .util import *
+
+class WindowIndex:
+    """
+    Constant time mean/min/max of one history column over any window
+    of months ending at any (year, month).
+    Missing (NaN) values are skipped like pandas does.
+    """
+
+    def __init__(self, years, months, values):
+        self._rows = {
+            (int(y), int(m)): i for i, (y, m) in enumerate(zip(years, months))
+        }
+        v = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(v)
+        self._values = v
+
+        # prefix sums: sum/count of v[start:end] is prefix[end] - prefix[start]
+        self._sums = np.concatenate(([0.0], np.cumsum(np.where(valid, v, 0.0))))
+        self._counts = np.concatenate(([0], np.cumsum(valid)))
+
+        # sparse tables: level k holds min/max of v[i:i+2**k]
+        self._mins = [np.where(valid, v, np.inf)]
+        self._maxs = [np.where(valid, v, -np.inf)]
+        k = 1
+        while (1 << k) <= len(v):
+            half = 1 << (k-1)
+            self._mins.append(np.minimum(self._mins[-1][:-half], self._mins[-1][half:]))
+            self._maxs.append(np.maximum(self._maxs[-1][:-half], self._maxs[-1][half:]))
+            k += 1
+        debug2(f"WindowIndex: {len(v)} rows, {k} levels")
+
+    def end(self, until):
+        """Row offset just after month `until` = (year, month)"""
+        row = self._rows.get((int(until[0]), int(until[1])), None)
+        if row is None:
+            error(f"history: no data for {until[0]}-{until[1]}")
+        return row + 1
+
+    def window(self, end, num):
+        start = max(0, end - num)
+        count = self._counts[end] - self._counts[start]
+        if count == 0:
+            return {"mean": np.nan, "min": np.nan, "max": np.nan}
+        k = (end - start).bit_length() - 1
+        return {
+            "mean": float((self._sums[end] - self._sums[start]) / count),
+            "min": float(min(self._mins[k][start], self._mins[k][end - (1 << k)])),
+            "max": float(max(self._maxs[k][start], self._maxs[k][end - (1 << k)])),
+        }
+
+    def percentiles(self, end, num, qs):
+        values = self._values[max(0, end - num):end]
+        return {q: float(p) for q, p in zip(qs, np.nanpercentile(values, qs))}
@@ -0,0 +1,63 @@
+import json
+import time
+from decimal import Decimal
+
+import pytest
+
+from autopie import allocate, currency
+from autopie.core import Provider, Product, Price, RealPortfolio
+
+class Fake(Provider):
+    def __init__(self, name, products, cash):
+        super().__init__(name)
+        self._products = products
+        self._cash = cash
+        self._assets = []
+
+    def init(self, **data):
+        pass
+
+    def clean(self):
+        pass
+
+    @property
+    def buyable(self):
+        return self._products
+
+    @property
+    def cash(self):
+        return self._cash
+
+@pytest.fixture(autouse=True)
+def rates(tmp_path):
+    cache = tmp_path / "rates.json"
+    cache.write_text(json.dumps({"usd": {"timestamp": time.time(), "rates": {"usd": 1}}}))
+    currency.init(cache_file=str(cache), offline=True, pivot="usd")
+
+def product(name, aclass, price):
+    return Product(name, aclass, Price(Decimal(price), "usd"), "p", {"quantity_places": 0})
+
+def test_plan_mixes_products_sharing_cash():
+    # the most lots of A leave 80; one of A and one of B spend 90
+    provider = Fake("p", [product("A", "a", 20), product("B", "b", 70)], Price(Decimal(100), "usd"))
+    portfolio = RealPortfolio(values={"a": Decimal(90), "b": Decimal(70)}, currency="usd")
+    orders, exact = allocate.plan(portfolio, [provider])
+    assert exact
+    assert sorted((o.product.name, o.amount) for o in orders) == [("A", 1), ("B", 1)]
+    assert sum(o.cost for o in orders) == Decimal(90)
+
+def test_plan_not_exact_when_out_of_nodes():
+    provider = Fake("p", [product("A", "a", 20), product("B", "b", 70)], Price(Decimal(100), "usd"))
+    portfolio = RealPortfolio(values={"a": Decimal(90), "b": Decimal(70)}, currency="usd")
+    orders, exact = allocate.plan(portfolio, [provider], node_budget=1)
+    assert not exact
+    assert orders
+
+def test_plan_ignores_products_that_never_fit():
+    # a lot of C costs more than its budget and the cash
+    provider = Fake("p", [product("A", "a", 20), product("B", "b", 70), product("C", "c", 500)],
+            Price(Decimal(100), "usd"))
+    portfolio = RealPortfolio(values={"a": Decimal(90), "b": Decimal(70), "c": Decimal(400)}, currency="usd")
+    orders, exact = allocate.plan(portfolio, [provider])
+    assert exact
+    assert sorted((o.product.name, o.amount) for o in orders) == [("A", 1), ("B", 1)]
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from autopie.colstore import ColumnStore
+
+def frame(n, scale=1.0):
+    return pd.DataFrame({
+        "year": np.arange(n) // 12 + 2000,
+        "month": np.arange(n) % 12 + 1,
+        "price": np.arange(n) * scale,
+    })
+
+def reread(path):
+    return ColumnStore(path).read(ints=("year", "month"))
+
+def test_append_in_place(tmp_path):
+    path = str(tmp_path / "h")
+    store = ColumnStore(path)
+    store.write(frame(5), range(5))
+    store.write(frame(8), [5, 6, 7])
+    assert store.generation == 1
+    df = reread(path)
+    pd.testing.assert_frame_equal(df, frame(8))
+    assert df["year"].dtype == np.int64
+    assert sorted(os.listdir(path)) == ["0.1.f64", "1.1.f64", "2.1.f64", "meta.json"]
+
+def test_update_writes_new_generation(tmp_path):
+    path = str(tmp_path / "h")
+    store = ColumnStore(path)
+    store.write(frame(5), range(5))
+    changed = frame(5)
+    changed.loc[2, "price"] = np.nan
+    store.write(changed, [2])
+    assert store.generation == 2
+    pd.testing.assert_frame_equal(reread(path), changed)
+    # the previous generation is gone
+    assert sorted(os.listdir(path)) == ["0.2.f64", "1.2.f64", "2.2.f64", "meta.json"]
+
+def test_new_column_rewrites(tmp_path):
+    path = str(tmp_path / "h")
+    store = ColumnStore(path)
+    store.write(frame(3), range(3))
+    wider = frame(3).assign(gold=[1.0, 2.0, 3.0])
+    store.write(wider, [])
+    pd.testing.assert_frame_equal(reread(path), wider)
+
+def test_interrupted_update_keeps_old_contents(tmp_path, monkeypatch):
+    path = str(tmp_path / "h")
+    store = ColumnStore(path)
+    store.write(frame(4), range(4))
+    def crash(*args):
+        raise OSError("power cut")
+    monkeypatch.setattr(store, "_commit", crash)
+    with pytest.raises(OSError):
+        store.write(frame(4, scale=2.0), [1])
+    pd.testing.assert_frame_equal(reread(path), frame(4))
+
+def test_interrupted_append_keeps_old_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / "h")
+    store = ColumnStore(path)
+    store.write(frame(4), range(4))
+    monkeypatch.setattr(store, "_commit", lambda *args: None)
+    store.write(frame(6), [4, 5])
+    pd.testing.assert_frame_equal(reread(path), frame(4))
@@ -0,0 +1,35 @@
+import json
+import time
+from decimal import Decimal
+
+import pytest
+
+from autopie import currency, transport
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return json.loads(self._body)
+
+@pytest.fixture
+def stale(tmp_path):
+    cache = tmp_path / "rates.json"
+    day_ago = time.time() - 24 * 60 * 60
+    cache.write_text(json.dumps({"eur": {"timestamp": day_ago, "rates": {"czk": 25}}}))
+    currency.init(cache_file=str(cache), pivot="eur")
+
+@pytest.mark.parametrize("body", ['{"eur": {"czk": 2', "<html>", "[]"])
+def test_bad_reply_falls_back_to_stale_rates(stale, monkeypatch, body):
+    monkeypatch.setattr(transport, "get", lambda url, validators: (Response(200, body), {}))
+    assert currency.get_rate("eur", "czk") == Decimal(25)
+
+def test_fresh_reply_is_cached(stale, tmp_path, monkeypatch):
+    body = json.dumps({"eur": {"czk": 24, "usd": 1.25}})
+    monkeypatch.setattr(transport, "get", lambda url, validators: (Response(200, body), {"etag": "x"}))
+    assert currency.get_rate("usd", "czk") == Decimal(24) / Decimal("1.25")
+    cached = json.loads((tmp_path / "rates.json").read_text())
+    assert cached["eur"]["rates"] == {"czk": 24, "usd": 1.25}
+    assert cached["eur"]["etag"] == "x"
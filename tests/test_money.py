@@ -0,0 +1,71 @@
+import json
+import time
+from decimal import Decimal, ROUND_DOWN, ROUND_UP
+
+import pytest
+
+from autopie import currency, money
+from autopie.money import Money
+from autopie.core import RealPortfolio
+
+def test_to_units_rounding():
+    assert money.to_units(Decimal("1.005"), 2) == 100
+    assert money.to_units(Decimal("1.015"), 2) == 102
+    assert money.to_units(Decimal("1.019"), 2, rounding=ROUND_DOWN) == 101
+    assert money.to_units(Decimal("1.011"), 2, rounding=ROUND_UP) == 102
+    assert money.to_units(3, 2) == 300
+    # floats by their shortest form, not their binary value
+    assert money.to_units(0.1, 8) == 10**7
+    assert money.to_units("2.5", 0) == 2
+
+def test_to_units_of_money_checks_unit():
+    m = Money(12345, "czk")
+    assert money.to_units(m, 2, unit="czk") == 12345
+    assert money.to_units(m, 4, unit="czk") == 1234500
+    assert money.to_units(m, 0, rounding=ROUND_UP, unit="czk") == 124
+    with pytest.raises(SystemExit):
+        money.to_units(m, 2, unit="usd")
+    with pytest.raises(SystemExit):
+        money.to_units(m, 2)
+
+def test_money_arithmetic():
+    a = Money.of("10.10", "USD")
+    assert (a.units, a.unit) == (1010, "usd")
+    assert a + Money.of(1, "usd") == Money(1110, "usd")
+    assert Money.of(Decimal("0.123456789"), "btc").units == 12345679
+    assert a.mul(Decimal(1) / 3, rounding=ROUND_DOWN) == Money(336, "usd")
+    assert a.convert("czk", Decimal("22.5")) == Money(22725, "czk")
+    with pytest.raises(SystemExit):
+        a + Money(1, "czk")
+    with pytest.raises(SystemExit):
+        Money.of(a, "czk")
+
+def test_portfolio_keeps_exact_units():
+    p = RealPortfolio(values={"stock": Decimal("0.1"), "gold": Decimal("0.2")}, currency="czk")
+    assert p.total == Decimal("0.3")
+    p *= Decimal(1) / 3
+    assert p.values == {"stock": Decimal("0.03"), "gold": Decimal("0.07")}
+    assert p.amount("stock") == Money(3, "czk")
+
+def test_portfolio_of_money_in_other_currency():
+    with pytest.raises(SystemExit):
+        RealPortfolio(values={"stock": Money(100, "usd")}, currency="czk")
+    p = RealPortfolio(values={"stock": Money(100, "czk")}, currency="czk")
+    assert p.total == Decimal(1)
+
+@pytest.fixture
+def rates(tmp_path):
+    cache = tmp_path / "rates.json"
+    cache.write_text(json.dumps({"usd": {"timestamp": time.time(), "rates": {"czk": 22.58}}}))
+    currency.init(cache_file=str(cache), offline=True, pivot="usd")
+
+def test_portfolio_converts_with_explicit_rounding(rates):
+    p = RealPortfolio(values={"stock": Decimal(100)}, currency="czk")
+    # 0.01 usd = 0.2258 czk: half-even when added, down when taken
+    cent = RealPortfolio(values={"stock": Decimal("0.01")}, currency="usd")
+    p += cent
+    assert p.amount("stock") == Money(10023, "czk")
+    p -= cent
+    assert p.amount("stock") == Money(10001, "czk")
+    with pytest.raises(SystemExit):
+        p -= RealPortfolio(values={"stock": Decimal(5)}, currency="usd")
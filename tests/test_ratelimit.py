@@ -0,0 +1,44 @@
+import pytest
+
+from autopie.ratelimit import RateLimiter
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def limiter(clock, rate=5, burst=4):
+    return RateLimiter(rate, burst, clock=clock, sleep=clock.sleep)
+
+def test_burst_then_rate():
+    clock = Clock()
+    limit = limiter(clock)
+    assert [limit.acquire() for _ in range(4)] == [0.0] * 4
+    assert limit.acquire() == pytest.approx(0.2)
+    assert limit.acquire() == pytest.approx(0.2)
+    assert clock.now == pytest.approx(0.4)
+    assert (limit.requests, limit.throttled) == (6, 2)
+    assert limit.throttled_time == pytest.approx(0.4)
+
+def test_tokens_refill_up_to_burst():
+    clock = Clock()
+    limit = limiter(clock)
+    for _ in range(4):
+        limit.acquire()
+    clock.now += 60
+    assert [limit.acquire() for _ in range(4)] == [0.0] * 4
+    assert limit.acquire() == pytest.approx(0.2)
+
+def test_waiting_callers_reserve_their_turn():
+    # callers arriving together, before any of them slept
+    clock = Clock()
+    limit = RateLimiter(5, 1, clock=clock, sleep=lambda seconds: None)
+    waits = [limit.acquire() for _ in range(4)]
+    assert waits == pytest.approx([0.0, 0.2, 0.4, 0.6])
@@ -0,0 +1,180 @@
+from decimal import Decimal
+
+import pytest
+
+from autopie import storage
+from autopie.core import RealPortfolio
+
+BACKENDS = {"json": "data.store", "sqlite": "data.sqlite"}
+
+@pytest.fixture(params=list(BACKENDS))
+def backend(request):
+    return request.param
+
+def opened(tmp_path, backend, namespace=None):
+    store = storage.BACKENDS[backend](str(tmp_path / BACKENDS[backend]), namespace=namespace)
+    store.open()
+    return store
+
+def remains(czk):
+    return RealPortfolio(values={"stock": Decimal(czk)}, currency="czk")
+
+def test_namespaces_are_apart(tmp_path, backend):
+    a = opened(tmp_path, backend, "a")
+    b = opened(tmp_path, backend, "b")
+    a.save("remains", remains(100))
+    b.save("remains", remains(200))
+    a.close(); b.close()
+    a = opened(tmp_path, backend, "a")
+    assert a.load("remains").total == 100
+    a.close()
+
+def test_namespace_takes_over_value_without_one(tmp_path, backend, capsys):
+    store = opened(tmp_path, backend)
+    store.save("remains", remains(2000))
+    store.close()
+
+    store = opened(tmp_path, backend, "acc1")
+    assert store.load("remains").total == 2000
+    assert "no remains in namespace acc1" in capsys.readouterr().out
+    store.save("remains", remains(500))
+    store.close()
+
+    # moved: not left behind for another account
+    store = opened(tmp_path, backend, "acc2")
+    assert store.load("remains") is None
+    store.close()
+    store = opened(tmp_path, backend, "acc1")
+    assert store.load("remains").total == 500
+    store.close()
+
+def test_new_sqlite_imports_json_into_namespace(tmp_path):
+    old = opened(tmp_path, "json")
+    old.save("remains", remains(2000))
+    old.save("other/remains", remains(7))
+    old.close()
+
+    store = storage.SQLiteStorage(str(tmp_path / "data.sqlite"), namespace="acc1",
+            previous=str(tmp_path / "data.store"))
+    store.open()
+    assert store.load("remains").total == 2000
+    store.close()
+    store = opened(tmp_path, "sqlite", "other")
+    assert store.load("remains").total == 7
+    store.close()
+
+def test_sqlite_imports_only_when_created(tmp_path):
+    opened(tmp_path, "sqlite").close()
+    old = opened(tmp_path, "json")
+    old.save("remains", remains(2000))
+    old.close()
+    store = storage.SQLiteStorage(str(tmp_path / "data.sqlite"), previous=str(tmp_path / "data.store"))
+    store.open()
+    assert store.load("remains") is None
+    store.close()
+
+def test_init_storage_imports_configured_json_file(tmp_path, monkeypatch):
+    from autopie.main import init_storage
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    old = storage.JSONStorage(str(tmp_path / "autopie" / "mine.store"))
+    old.open()
+    old.save("remains", remains(2000))
+    old.close()
+    init_storage({
+        "storage_backend": "sqlite",
+        "storage_namespace": "acc1",
+        "storage_import_file": "mine.store",
+    })
+    try:
+        assert storage.load("remains").total == 2000
+    finally:
+        storage.clean()
+
+@pytest.mark.parametrize("backend, other", [("json", "sqlite"), ("sqlite", "json")])
+def test_refuses_file_of_other_backend(tmp_path, backend, other):
+    opened(tmp_path, other).close()
+    (tmp_path / BACKENDS[other]).rename(tmp_path / BACKENDS[backend])
+    with pytest.raises(SystemExit):
+        opened(tmp_path, backend)
+
+def test_sqlite_opens_while_another_run_writes(tmp_path):
+    store = opened(tmp_path, "sqlite")
+    store.close()
+    writer = opened(tmp_path, "sqlite")
+    with writer.transaction():
+        writer.save("remains", remains(1))
+        # reads the last committed values without waiting for the writer
+        reader = storage.SQLiteStorage(str(tmp_path / "data.sqlite"))
+        reader.TIMEOUT = 0.1
+        reader.open()
+        assert reader.load("remains") is None
+        reader.close()
+    writer.close()
+
+def test_sqlite_journal_per_account(tmp_path):
+    for account, czk in (("acc1", 100), ("acc2", 50), ("acc1", 20)):
+        store = opened(tmp_path, "sqlite", account)
+        with store.transaction():
+            store.begin_run("CZK")
+            store.journal("plan", remains(czk * 2))
+            store.journal("fill", remains(czk), provider="xtb")
+        store.close()
+    store = opened(tmp_path, "sqlite", "acc1")
+    assert store.bought() == {"czk": {"stock": Decimal(120)}}
+    assert store.bought(aclass="gold") == {}
+    store.close()
+    store = opened(tmp_path, "sqlite")
+    assert store.bought() == {"czk": {"stock": Decimal(170)}}
+    store.close()
+
+def test_transaction_commits_at_the_end(tmp_path, backend):
+    store = opened(tmp_path, backend)
+    with store.transaction():
+        store.save("remains", remains(1))
+        with store.transaction():
+            store.save("ideal", remains(2))
+        # not yet visible to others
+        other = opened(tmp_path, backend)
+        assert other.load("remains") is None
+        other.close()
+    other = opened(tmp_path, backend)
+    assert other.load("remains").total == 1
+    assert other.load("ideal").total == 2
+    other.close()
+    store.close()
+
+def test_failed_transaction_rolls_back(tmp_path, backend):
+    store = opened(tmp_path, backend)
+    store.save("remains", remains(1))
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.save("remains", remains(2))
+            store.save("ideal", remains(3))
+            raise RuntimeError("provider failed")
+    assert store.load("remains").total == 1
+    assert store.load("ideal") is None
+    store.close()
+    store = opened(tmp_path, backend)
+    assert store.load("remains").total == 1
+    store.close()
+
+def test_json_commit_keeps_values_of_other_processes(tmp_path):
+    a = opened(tmp_path, "json")
+    b = opened(tmp_path, "json")
+    a.save("remains", remains(1))
+    b.save("ideal", remains(2))
+    c = opened(tmp_path, "json")
+    assert c.load("remains").total == 1
+    assert c.load("ideal").total == 2
+    for store in (a, b, c):
+        store.close()
+
+def test_plain_values_and_decimals(tmp_path, backend):
+    store = opened(tmp_path, backend)
+    store.save("count", {"runs": [1, 2]})
+    store.save("spent", Decimal("12.34"))
+    store.close()
+    store = opened(tmp_path, backend)
+    assert store.load("count") == {"runs": [1, 2]}
+    assert store.load("spent") == Decimal("12.34")
+    store.close()
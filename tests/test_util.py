@@ -0,0 +1,26 @@
+import json
+import threading
+
+import pytest
+
+from autopie import util
+
+def test_write_json_concurrent_writers(tmp_path):
+    file = str(tmp_path / "cache" / "rates.json")
+    def write(i):
+        for n in range(50):
+            util.write_json(file, {"writer": i, "n": n})
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(file) as f:
+        assert json.load(f)["n"] == 49
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == ["rates.json"]
+
+def test_write_json_failure_leaves_no_temp_file(tmp_path):
+    file = str(tmp_path / "rates.json")
+    with pytest.raises(TypeError):
+        util.write_json(file, {"not json": object()})
+    assert list(tmp_path.iterdir()) == []
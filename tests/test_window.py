@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from autopie.window import WindowIndex
+
+@pytest.fixture
+def column():
+    rng = np.random.default_rng(1)
+    values = rng.normal(100, 20, 150)
+    values[[0, 7, 8, 9, 40, 149]] = np.nan
+    values[60:75] = np.nan # a whole window of nothing
+    years = [2000 + i // 12 for i in range(len(values))]
+    months = [1 + i % 12 for i in range(len(values))]
+    return pd.DataFrame({"year": years, "month": months, "value": values})
+
+@pytest.mark.parametrize("num", [1, 2, 3, 12, 13, 100, 500])
+def test_window_matches_pandas(column, num):
+    index = WindowIndex(column["year"], column["month"], column["value"])
+    for row in range(len(column)):
+        until = (column["year"][row], column["month"][row])
+        end = index.end(until)
+        expected = column["value"][max(0, end - num):end]
+        got = index.window(end, num)
+        for stat in ("mean", "min", "max"):
+            want = getattr(expected, stat)()
+            if np.isnan(want):
+                assert np.isnan(got[stat]), (row, stat)
+            else:
+                assert got[stat] == pytest.approx(want, rel=1e-12), (row, stat)
+
+def test_percentiles_match_pandas(column):
+    index = WindowIndex(column["year"], column["month"], column["value"])
+    end = index.end((2010, 6))
+    expected = column["value"][end - 36:end].quantile([0.1, 0.5, 0.9])
+    got = index.percentiles(end, 36, [10, 50, 90])
+    assert list(got.values()) == pytest.approx(list(expected))
+
+def test_unknown_month(column):
+    index = WindowIndex(column["year"], column["month"], column["value"])
+    with pytest.raises(SystemExit):
+        index.end((1999, 12))
@@ -0,0 +1,111 @@
+import json
+import queue
+import threading
+
+import pytest
+
+from autopie.providers import xtb_client
+from autopie.providers.xtb_client import XTBClient, XTBStream
+from autopie.ratelimit import RateLimiter
+
+class FakeSocket:
+    """Web socket whose server side is the test: reply() and drop()"""
+
+    def __init__(self):
+        self.sent = []
+        self._incoming = queue.Queue()
+        self._sent = threading.Condition()
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, message):
+        with self._sent:
+            self.sent.append(json.loads(message))
+            self._sent.notify_all()
+
+    def recv(self):
+        message = self._incoming.get()
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        self._incoming.put(ConnectionError("closed"))
+
+    def reply(self, message):
+        self._incoming.put(message if isinstance(message, str) else json.dumps(message))
+
+    def drop(self):
+        # websocket-client returns "" once the server closed
+        self._incoming.put("")
+
+    def wait_sent(self, n):
+        with self._sent:
+            assert self._sent.wait_for(lambda: len(self.sent) >= n, 2)
+        return self.sent[n-1]
+
+@pytest.fixture
+def socket(monkeypatch):
+    socket = FakeSocket()
+    monkeypatch.setattr(xtb_client, "create_connection", lambda url, timeout: socket)
+    return socket
+
+def client(timeout=2):
+    return XTBClient("wss://fake", timeout, RateLimiter(1000, 1000))
+
+def test_replies_routed_by_custom_tag(socket):
+    c = client()
+    trades = c.request("getTrades", openedOnly=True)
+    user = c.request("getCurrentUserData")
+    assert socket.wait_sent(2)["command"] == "getCurrentUserData"
+    assert socket.sent[0]["arguments"] == {"openedOnly": True}
+    # out of order
+    socket.reply({"status": True, "returnData": {"currency": "CZK"}, "customTag": socket.sent[1]["customTag"]})
+    socket.reply({"status": False, "errorCode": "E1", "errorDescr": "no", "customTag": socket.sent[0]["customTag"]})
+    assert c.wait(user) == (True, {"currency": "CZK"})
+    assert c.wait(trades) == (False, "E1: no")
+    c.close()
+
+def test_login_reply_carries_stream_session(socket):
+    c = client()
+    login = c.request("login", userId="1", password="x")
+    tag = socket.wait_sent(1)["customTag"]
+    socket.reply({"status": True, "streamSessionId": "s1", "customTag": tag})
+    assert c.wait(login) == (True, {"streamSessionId": "s1"})
+    c.close()
+
+def test_server_close_fails_pending_and_later_requests(socket):
+    c = client(timeout=30)
+    trades = c.request("getTrades")
+    socket.wait_sent(1)
+    socket.drop()
+    # at once, not after the timeout
+    assert trades.result(timeout=2) == (False, "web socket closed")
+    c._reader.join(2)
+    assert c.closed
+    assert c.call("getServerTime") == (False, "web socket closed")
+    assert len(socket.sent) == 1
+
+def test_garbage_closes_client(socket):
+    c = client(timeout=30)
+    trades = c.request("getTrades")
+    socket.wait_sent(1)
+    socket.reply('{"status": tru')
+    assert trades.result(timeout=2) == (False, "web socket closed")
+    assert c.closed
+
+def test_stream_keeps_best_prices_and_closes(socket):
+    stream = XTBStream("wss://fake", "s1", 2)
+    stream.subscribe_prices(["GOLD"])
+    assert socket.wait_sent(1) == {"command": "getTickPrices", "streamSessionId": "s1", "symbol": "GOLD", "maxLevel": 0}
+    socket.reply({"command": "tickPrices", "data": {"symbol": "GOLD", "level": 1, "bid": 1, "ask": 2}})
+    socket.reply({"command": "tickPrices", "data": {"symbol": "GOLD", "level": 0, "bid": 10, "ask": 11}})
+    socket.reply({"command": "balance", "data": {"balance": 100}})
+    assert stream.wait_for(lambda s: s.balance is not None, 2)
+    assert stream.prices == {"GOLD": (10, 11)}
+    # waiting on a balance that never comes ends with the connection
+    threading.Timer(0.1, socket.drop).start()
+    assert stream.wait_for(lambda s: s.balance["balance"] >= 1000, 5) is None
+    assert stream.closed
+    assert stream.prices == {} and stream.balance is None